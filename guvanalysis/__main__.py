@@ -1,12 +1,173 @@
-from .app import run
-from .plotting import run as plot
 import argparse
+from .parameters import ParameterList
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(prog='python -m guvanalysis',description='GUV analysis script')    
+    parser = argparse.ArgumentParser(prog='python -m guvanalysis',description='GUV analysis script')
     parser.add_argument("--show-plots", action="store_true", default=False, help="Show plots of previous analysis")
+    parser.add_argument("--binned", action="store_true", default=False, help="Plot binned data instead of every GUV (for large numbers of GUVs, the bins are cached)")
+    parser.add_argument("--bins", type=int, default=100, help="Number of bins of every variable in binned plots")
+    parser.add_argument("--sample", type=int, default=None, metavar="N", help="Only plot a random selection of at most N GUVs of every series")
+    subparsers = parser.add_subparsers(dest="command", metavar="command", help="Run without a command to start the GUI")
+
+    timelapse_parser = subparsers.add_parser("timelapse", help="Analyse all time points of a time-lapse file and track GUVs over time")
+    timelapse_parser.add_argument("parameters", help="Parameters file (.json) of an earlier analysis of the file")
+    timelapse_parser.add_argument("-o", "--output", default=None, help="Name of the output csv file")
+    timelapse_parser.add_argument("-j", "--workers", type=int, default=None, help="Number of time points that are analysed in parallel")
+    timelapse_parser.add_argument("--time-points", type=int, nargs=2, metavar=("START", "STOP"), default=None, help="Only analyse time points START up to (excluding) STOP")
+
+    batch_parser = subparsers.add_parser("batch", help="Analyse multiple series without GUI, continues where an interrupted run stopped")
+    batch_parser.add_argument("parameters", help="Parameters file (.json) with the file and parameters to use")
+    batch_parser.add_argument("--series", type=int, nargs="+", default=None, help="Series to analyse (all series if not given)")
+    batch_parser.add_argument("-j", "--workers", type=int, default=None, help="Number of series that are analysed in parallel")
+    batch_parser.add_argument("--overlays", action="store_true", default=False, help="Also store an image with the found GUVs for every series (see the overlay command)")
+
+    overlay_parser = subparsers.add_parser("overlay", help="Store images with the found GUVs drawn on the stack, to check the results of batch runs")
+    overlay_parser.add_argument("datafiles", nargs="+", help="GUVdata .csv files (the GUVparams .json file should be next to them)")
+    overlay_parser.add_argument("--frames", action="store_true", default=False, help="Draw the GUVs on every frame (as a montage) instead of on the maximum projection")
+    overlay_parser.add_argument("--columns", type=int, default=None, help="Number of frames next to each other in the montage")
+    overlay_parser.add_argument("--format", choices=["png", "tif"], default="png", help="Image format")
+    overlay_parser.add_argument("-j", "--workers", type=int, default=None, help="Number of images that are rendered in parallel")
+
+    convert_parser = subparsers.add_parser("convert", help="Convert a directory of tif files to a single cached stack file that is used by later analyses")
+    convert_parser.add_argument("pattern", help="Pattern of the tif files, e.g. \"data/*.tif\" (with quotes)")
+
+    sweep_parser = subparsers.add_parser("sweep", help="Evaluate a grid of parameter values to find good settings")
+    sweep_parser.add_argument("parameters", help="Parameters file (.json) of an earlier analysis, used for all parameters that are not swept")
+    for varname, props in ParameterList().get_adjustable_variables().items():
+        sweep_parser.add_argument(f"--{varname}", default=None, metavar="VALUES",
+                                  help=f"{props['helptext']}. Either a value, a list (1,2,5) or a range (start:stop:step)")
+    sweep_parser.add_argument("-o", "--output", default=None, help="Name of the csv file to store the summary table in")
+    sweep_parser.add_argument("-j", "--workers", type=int, default=None, help="Number of worker processes")
+
+    benchmark_parser = subparsers.add_parser("benchmark", help="Compare the speed of the compiled edge detection (requires numba) with the default one")
+    benchmark_parser.add_argument("parameters", help="Parameters file (.json) with the file, channel and blur radius to use")
+    benchmark_parser.add_argument("--repeat", type=int, default=3, help="Number of repetitions, the fastest one is shown")
+
+    query_parser = subparsers.add_parser("query", help="Get the GUVs of all analyses from the results index, e.g. --where \"r_um > 10\" --since 2020-05-01")
+    query_parser.add_argument("--file", default=None, help="Pattern of the analysed files, e.g. \"*/plate_*.nd2\" (with quotes)")
+    query_parser.add_argument("--since", default=None, help="Only analyses on or after this date (YYYY-MM-DD)")
+    query_parser.add_argument("--until", default=None, help="Only analyses before this date (YYYY-MM-DD)")
+    query_parser.add_argument("--where", default=None, help="Condition on the GUVs, e.g. \"r_um > 10 AND intensity > 0.5\"")
+    query_parser.add_argument("--analyses", action="store_true", default=False, help="List the matching analyses instead of the GUVs (with --where: the analyses with at least one matching GUV)")
+    query_parser.add_argument("--plot", action="store_true", default=False, help="Plot the matching GUVs")
+    query_parser.add_argument("--binned", action="store_true", default=False, help="Plot binned data instead of every GUV (for large numbers of GUVs, the bins are cached)")
+    query_parser.add_argument("--bins", type=int, default=100, help="Number of bins of every variable in binned plots")
+    query_parser.add_argument("--sample", type=int, default=None, metavar="N", help="Only plot a random selection of at most N GUVs of every file and series")
+    query_parser.add_argument("-o", "--output", default=None, help="Name of the csv file to store the result in")
+    query_parser.add_argument("--index", default=None, help="Results index to use (the default one in the home directory if not given)")
+
+    index_parser = subparsers.add_parser("index", help="Add data files of earlier analyses to the results index")
+    index_parser.add_argument("datafiles", nargs="+", help="GUVdata .csv files (the GUVparams .json file should be next to them)")
+    index_parser.add_argument("--index", default=None, help="Results index to use (the default one in the home directory if not given)")
+
+    watch_parser = subparsers.add_parser("watch", help="Analyse new nd2 files and tif directories in a directory as soon as they have been acquired")
+    watch_parser.add_argument("directory", help="Directory to watch (including subdirectories)")
+    watch_parser.add_argument("parameters", help="Parameters file (.json) with the parameters to use, the file and series are ignored")
+    watch_parser.add_argument("-j", "--workers", type=int, default=None, help="Number of series that are analysed in parallel")
+    watch_parser.add_argument("--interval", type=float, default=10., help="Time (s) between two scans of the directory")
+    watch_parser.add_argument("--settle", type=float, default=30., help="Time (s) a file should be unchanged before it is analysed")
+    watch_parser.add_argument("--once", action="store_true", default=False, help="Analyse everything that is ready and stop")
+
+    serve_parser = subparsers.add_parser("serve", help="Start a job server that analyses the jobs of all users of this computer with a fixed number of cores")
+    serve_parser.add_argument("-j", "--cores", type=int, default=None, help="Number of cores the jobs can use together (number of cpus if not given)")
+    serve_parser.add_argument("--port", type=int, default=None, help="Port of the job server (localhost only)")
+
+    submit_parser = subparsers.add_parser("submit", help="Submit the analysis of series of a file to the job server")
+    submit_parser.add_argument("parameters", help="Parameters file (.json) with the file and parameters to use")
+    submit_parser.add_argument("--series", type=int, nargs="+", default=None, help="Series to analyse (all series if not given)")
+    submit_parser.add_argument("--port", type=int, default=None, help="Port of the job server (localhost only)")
+
+    jobs_parser = subparsers.add_parser("jobs", help="Show the jobs of the job server with their status and timings")
+    jobs_parser.add_argument("job", type=int, nargs="?", default=None, help="Only show this job")
+    jobs_parser.add_argument("--mine", action="store_true", default=False, help="Only show your own jobs")
+    jobs_parser.add_argument("--cancel", action="store_true", default=False, help="Cancel the job (if it has not started yet)")
+    jobs_parser.add_argument("--port", type=int, default=None, help="Port of the job server (localhost only)")
+
     args = parser.parse_args()
-    if args.show_plots:
-        plot()
+    if args.command == "timelapse":
+        from .timelapse import analyse_timelapse
+        time_points = range(*args.time_points) if args.time_points else None
+        outfilename = analyse_timelapse(ParameterList.from_json(args.parameters), args.output, time_points, args.workers)
+        print(f"Time-lapse data stored in {outfilename}")
+    elif args.command == "sweep":
+        from .sweep import run_sweep, parse_range, parameter_types
+        ranges = {varname: parse_range(getattr(args, varname), vartype) for varname, vartype in parameter_types().items() if getattr(args, varname) is not None}
+        summary = run_sweep(ParameterList.from_json(args.parameters), ranges, args.workers)
+        print(summary.to_string(index=False))
+        if args.output:
+            summary.to_csv(args.output, index=False, header=True)
+            print(f"Summary stored in {args.output}")
+    elif args.command == "batch":
+        from .batch import run_batch
+        results = run_batch(ParameterList.from_json(args.parameters), args.series, args.workers)
+        if args.overlays:
+            from .overlay import export_overlays
+            print(f"Overlays stored in {', '.join(export_overlays(results.values(), max_workers=args.workers))}")
+    elif args.command == "overlay":
+        from .overlay import export_overlays
+        for filename in export_overlays(args.datafiles, "." + args.format, args.frames, args.columns, max_workers=args.workers):
+            print(f"Overlay stored in {filename}")
+    elif args.command == "convert":
+        from .framesource import TiffSequenceSource
+        source = TiffSequenceSource(args.pattern)
+        print(f"Converting {source.sizes['c']} channels with {source.sizes['z']} slices")
+        print(f"Stack stored in {source.convert()}")
+    elif args.command == "benchmark":
+        from .fastdetect import benchmark
+        from .guvfinder import helpers
+        params = ParameterList.from_json(args.parameters)
+        frames = list(helpers.as_8bit(helpers.open_stack(params, t=params.time_point)))
+        result = benchmark(frames, params.blur_radius, args.repeat)
+        print(f"skimage: {result['skimage_s']:.3f} s, compiled: {result['compiled_s']:.3f} s for {result['frames']} frames "
+              f"(speedup {result['speedup']:.1f}x, {result['differing_pixels']} pixels differ)")
+    elif args.command == "watch":
+        from .watch import FolderWatcher
+        FolderWatcher(args.directory, ParameterList.from_json(args.parameters), args.workers, args.interval, args.settle).run(args.once)
+    elif args.command == "serve":
+        from .jobserver import JobServer, DEFAULT_PORT
+        JobServer(args.cores, args.port or DEFAULT_PORT).run()
+    elif args.command == "submit":
+        from .jobserver import submit_jobs, DEFAULT_PORT
+        ids = submit_jobs(ParameterList.from_json(args.parameters), args.series, port=args.port or DEFAULT_PORT)
+        print(f"Submitted jobs {', '.join(map(str, ids))}, see `python -m guvanalysis jobs` for their status")
+    elif args.command == "jobs":
+        import getpass
+        import pandas as pd
+        from .jobserver import list_jobs, cancel_job, server_status, DEFAULT_PORT
+        port = args.port or DEFAULT_PORT
+        if args.cancel:
+            if args.job is None:
+                parser.error("--cancel needs the id of a job")
+            print(f"Job {args.job} {'cancelled' if cancel_job(args.job, port) else 'cannot be cancelled, it is not queued'}")
+        else:
+            jobs = pd.DataFrame(list_jobs(args.job, getpass.getuser() if args.mine else None, port))
+            status = server_status(port)
+            print(f"{status['cores_in_use']} of {status['cores']} cores in use, jobs: {status['jobs']}")
+            if not jobs.empty:
+                print(jobs[['id', 'owner', 'filename', 'series', 'status', 'cores', 'submitted', 'wait_s', 'run_s', 'num_guvs', 'results', 'error']].to_string(index=False))
+    elif args.command == "query":
+        from .resultindex import ResultIndex
+        if args.plot:
+            from .plotting import run_query
+            run_query(args.index, args.binned, args.bins, args.sample, file=args.file, since=args.since, until=args.until, where=args.where)
+        else:
+            index = ResultIndex(args.index)
+            if args.analyses:
+                result = index.analyses(file=args.file, since=args.since, until=args.until, where=args.where)
+            else:
+                result = index.query(file=args.file, since=args.since, until=args.until, where=args.where)
+            print(result.to_string(index=False))
+            if args.output:
+                result.to_csv(args.output, index=False, header=True)
+                print(f"Result stored in {args.output}")
+    elif args.command == "index":
+        from .resultindex import ResultIndex
+        index = ResultIndex(args.index)
+        for datafile in args.datafiles:
+            print(f"Added {index.add_data_file(datafile)} GUVs of {datafile}")
+    elif args.show_plots:
+        from .plotting import run as plot
+        plot(args.binned, args.bins, args.sample)
     else:
+        from .app import run # the GUI is only imported when needed, such that the commands also work without display
         run()
@@ -1,14 +1,18 @@
 import tkinter as tk
 import tkinter.filedialog as filedialog
 from tkinter import ttk
+from tkinter.messagebox import askyesno
 from .guvcontrol import GUV_Control
 from .parameters import ParameterList
+from .guvfinder import helpers
+from .framesource import open_frame_source
+from .manifest import RunManifest
 from .tkhelpers import PhotoImage_cd
 from PIL import Image, ImageTk
 import pandas as pd
 import matplotlib.pyplot as plt
-import pims 
 import os
+from dataclasses import replace
 
 
 class GUI:
@@ -88,13 +92,7 @@ class GUI:
                 print("Given datafile is empty, please select another one")
                 datafilename = False
             
-        self.stack = pims.open(self.parameters['filename'])
-        self.stack.bundle_axes = 'yx'
-        self.stack.iter_axes = 'z'
-        self.stack.default_coords['c'] = params.channel
-        self.stack.default_coords['t'] = 0
-        if params.series:
-            self.stack.default_coords['v'] = params.series
+        self.stack = helpers.open_stack(replace(params, filename=self.parameters['filename']), t=params.time_point)
         
         GUV_Control(self.stack, params, data)
         print("Selected the following files:",filename, self.parameters['filename'], datafilename)
@@ -123,11 +121,6 @@ class GUI:
                 print("Tif file selected")
                 self.parameters['filename'] = os.path.join(self.parameters['directory'],"*.tif")
                 self.parameters['filetype'] = "tif"
-
-                # get pixel size
-                im = Image.open(filename) # open file with Pillow to extract metadata from it
-                self.parameters['pixel_microns'] = 1./im.info['resolution'][0] # saved in tiff info by imagej
-                im.close()
             else: # selected nd2 file
                 self.parameters['filename'] = filename
                 self.parameters['filetype'] = "nd2"
@@ -136,28 +129,24 @@ class GUI:
 
     def process_nd2(self):
         """Loads the nd2 file into the class and obtains and displays the metadata from the file"""
+        self.source = open_frame_source(self.parameters['filename'])
         if self.parameters['filetype'] == 'tif':
-            self.stack = pims.ImageSequenceND(self.parameters['filename'], axes_identifiers=['c','z'])
-            self.parameters['channels'] = [f"channel {i}" for i in range(self.stack.sizes['c'])]
-        else:
-            self.stack = pims.open(self.parameters['filename'])
-            self.stack.default_coords['t'] = 0
-            self.parameters['channels'] = self.stack[0].metadata['channels']
-            self.parameters['pixel_microns'] = self.stack[0].metadata['pixel_microns']
-        if "v" in self.stack.sizes:
-            self.stack.bundle_axes = 'vyx'
-            self.has_multiple_series = True
+            self.parameters['channels'] = [f"channel {i}" for i in range(self.source.sizes['c'])]
+            self.parameters['pixel_microns'] = self.source.metadata['pixel_microns'] # read from the tiff info saved by imagej
         else:
-            self.stack.bundle_axes = 'yx'
-            self.has_multiple_series = False
-        self.stack.iter_axes = 'z'
+            self.parameters['channels'] = self.source.metadata['channels']
+            self.parameters['pixel_microns'] = self.source.metadata['pixel_microns']
+            if self.source.sizes.get('t', 1) > 1:
+                print(f"File contains {self.source.sizes['t']} time points, only the first one is analysed here. "
+                      "Use `python -m guvanalysis timelapse <parameters file>` to analyse all time points")
+        self.has_multiple_series = "v" in self.source.sizes
         tvMeta = ttk.Treeview(self.window)
         tvMeta['columns'] = ("metaval")
         tvMeta.column("#0", width=250)
         tvMeta.column("metaval", minwidth=250)
         tvMeta.heading("#0", text="Key", anchor=tk.W)
         tvMeta.heading("metaval", text="Value", anchor=tk.W)
-        for metakey, metaval in self.stack[0].metadata.items():
+        for metakey, metaval in self.source.metadata.items():
             if not metaval:
                 metaval = '' # replace attributes that can't be parsed with an empty string
             tvMeta.insert('', "end", text=metakey, values=(metaval))
@@ -172,12 +161,12 @@ class GUI:
         self.widgets['lblHelp'].grid(column=0, row=0)
         self.widgets['lblIntChHelp'] = tk.Label(self.window, text='Channel for intensity')
         self.widgets['lblIntChHelp'].grid(column=0, row=1)
-        self.widgets['lbChannel'] = tk.Listbox(self.window, selectmode=tk.SINGLE, width=50, height = self.stack.sizes['c'], exportselection=0)
-        self.widgets['lbIntChannel'] = tk.Listbox(self.window, selectmode=tk.SINGLE, width=50, height = self.stack.sizes['c'], exportselection=0)
+        self.widgets['lbChannel'] = tk.Listbox(self.window, selectmode=tk.SINGLE, width=50, height = self.source.sizes['c'], exportselection=0)
+        self.widgets['lbIntChannel'] = tk.Listbox(self.window, selectmode=tk.SINGLE, width=50, height = self.source.sizes['c'], exportselection=0)
         for i,channel in enumerate(self.parameters['channels']):
             self.widgets['lbChannel'].insert(i,channel)
             self.widgets['lbIntChannel'].insert(i,channel)
-        self.widgets['lbChannel'].selection_set(first=(self.stack.sizes['c'] - 1))
+        self.widgets['lbChannel'].selection_set(first=(self.source.sizes['c'] - 1))
         self.widgets['lbIntChannel'].selection_set(first=0)
         self.widgets['lbChannel'].grid(column=1, row=0, ipady=5)
         self.widgets['lbIntChannel'].grid(column=1, row=1,ipady=5)
@@ -194,7 +183,6 @@ class GUI:
             return
         self.parameters['channel'] = int(self.widgets['lbChannel'].curselection()[0])
         self.parameters['intensity_channel'] = int(self.widgets['lbIntChannel'].curselection()[0])
-        self.stack.default_coords['c'] = self.parameters['channel']
         self.destroy_all()
         if self.has_multiple_series:
             self.open_seriesselector()
@@ -220,9 +208,9 @@ class GUI:
         self.widgets['scrollSeries'].pack(side="left", fill="y")
         self.widgets['tvSeries'].configure(yscrollcommand=self.widgets['scrollSeries'].set)
         self.images = [] # for some reason display images only works for members of the class, hence the `self.`
-        for i in range(self.stack.sizes['v']):
+        for i in range(self.source.sizes['v']):
             self.images.append(ImageTk.PhotoImage(
-                Image.fromarray(self.stack[self.stack.sizes['z']//2][i]).convert("RGB").resize((75, 75))))
+                Image.fromarray(self.source.get_frame(v=i, z=self.source.sizes.get('z', 1)//2, c=self.parameters['channel'])).convert("RGB").resize((75, 75))))
             self.widgets['tvSeries'].insert('', 'end', iid=i, image=self.images[i], values=[f"Series {i}"])
         
         self.widgets['lblHelp'] = tk.Label(self.window, text='Select multiple by holding the Ctrl key')
@@ -242,17 +230,22 @@ class GUI:
 
     def launch_GUV_GUI(self):
         """Open the GUV_GUI for every of the chosen series"""
+        manifest = RunManifest(self.parameters['filename']) # keeps track of finished series, such that an interrupted run can be continued
         for i in self.parameters['selected_series']:
-            print(f"Analysing series {i}")
-            self.stack.bundle_axes = 'yx'
             finderparams = ParameterList(filename=self.parameters['filename'],
                                          channel=self.parameters['channel'],
                                          intensity_channel=self.parameters['intensity_channel'],
                                          pixel_microns=self.parameters['pixel_microns'])
             if self.has_multiple_series:
-                self.stack.default_coords['v'] = i
                 finderparams.series = i
-            GUV_Control(self.stack, finderparams) # launch the GUI that can find GUVs and let the user remove them
+            resultsfilename = manifest.finished_results(finderparams, check_parameters=False)
+            if resultsfilename and askyesno(title='Series already analysed', master=self.root,
+                                            message=f"Series {i} has already been analysed, the results are stored in {resultsfilename}. Skip this series?"):
+                print(f"Skipping series {i}")
+                continue
+            print(f"Analysing series {i}")
+            manifest.mark_running(finderparams)
+            GUV_Control(self.source.zstack(c=finderparams.channel, v=finderparams.series), finderparams, manifest=manifest) # launch the GUI that can find GUVs and let the user remove them
             
         self.quit()
 
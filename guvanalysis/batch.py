@@ -0,0 +1,90 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import replace
+from .parameters import ParameterList
+from .guvfinder import GUV_finder, helpers
+from .framesource import open_frame_source
+from .manifest import RunManifest, analysis_key
+from .output import ResultWriter, store_results, find_results
+
+
+def find_series_GUVs(params: ParameterList, manifest: RunManifest = None):
+    """Find the GUVs of a single series without GUI (runs in a worker process of `run_batch`)
+
+    Finished stages are stored in the run manifest of the file (created if None), such that they
+    are reused when the analysis is interrupted and started again
+
+    Returns:
+        (ParameterList, pd.DataFrame): the parameters and the data of the GUVs
+    """
+    manifest = manifest or RunManifest(params.filename)
+    manifest.mark_running(params)
+    finder = GUV_finder(helpers.open_stack(params, t=params.time_point), params)
+    finder.manifest = manifest
+    finder.snapshot_filename = None
+    finder.run_analysis()
+    return params, finder.get_data()
+
+
+def analyse_series(params: ParameterList):
+    """Analyse a single series without GUI and store the results like the GUI does
+
+    Returns:
+        (int, int, str): the series, the number of GUVs found and the name of the data file
+    """
+    manifest = RunManifest(params.filename)
+    params, guv_data = find_series_GUVs(params, manifest)
+    writer = ResultWriter()
+    resultsfilename, _ = store_results(params, guv_data, manifest, writer)
+    writer.close()
+    return params.series, len(guv_data), resultsfilename
+
+
+def run_batch(params: ParameterList, series=None, max_workers: int = None):
+    """Analyse multiple series of a file with the same parameters, without GUI
+
+    Series that have been finished before with the same parameters are skipped, so an
+    interrupted batch can simply be started again.
+
+    Args:
+        params (ParameterList): parameters used for all series
+        series (list of int): series to analyse (all series in the file if None)
+        max_workers (int): number of series that are analysed in parallel (number of cpus if None)
+
+    Returns:
+        dict: the name of the data file for every series (series of which the analysis failed are left out)
+    """
+    if series is None:
+        with open_frame_source(params.filename) as source:
+            series = list(range(source.sizes['v'])) if 'v' in source.sizes else [None]
+
+    manifest = RunManifest(params.filename)
+    results, todo = {}, []
+    for i in series:
+        series_params = replace(params, series=i)
+        # identical analyses (same file contents and parameters) are found by their key, older ones in the manifest
+        resultsfilename = find_results(series_params, analysis_key(series_params, manifest.content_hash)) or manifest.finished_results(series_params)
+        if resultsfilename:
+            print(f"Series {i} has already been analysed, results are in {resultsfilename}")
+            results[i] = resultsfilename
+        else:
+            todo.append(series_params)
+
+    # the workers only find the GUVs, the results are written here in the background while the workers continue
+    writer = ResultWriter()
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+            # the manifest is sent with its content hash, such that the workers do not read the file again
+            futures = {executor.submit(find_series_GUVs, series_params, manifest): series_params for series_params in todo}
+            for future in as_completed(futures):
+                try:
+                    series_params, guv_data = future.result()
+                except Exception as e: # the other series are still analysed, this one is analysed again when the batch is restarted
+                    print(f"Analysis of series {futures[future].series} failed: {e}")
+                    continue
+                resultsfilename, _ = store_results(series_params, guv_data, manifest, writer)
+                print(f"Data for {len(guv_data)} GUVs of series {series_params.series} stored in {resultsfilename}")
+                results[series_params.series] = resultsfilename
+    finally:
+        writer.close() # the results of the finished series are also written when the batch is interrupted
+    return results
@@ -0,0 +1,322 @@
+import os
+import re
+import json
+import glob
+import hashlib
+import threading
+import struct
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pims
+from PIL import Image
+from slicerator import Slicerator # installed together with pims
+from nd2reader import ND2Reader
+
+
+class FrameSource:
+    """Read-only access to all frames of a file
+
+    Frames are requested with explicit (v, t, z, c) coordinates instead of setting
+    `default_coords` on a shared reader, so a single source can be used by multiple
+    threads at the same time. Use `zstack` to get the sequence that the rest of the
+    analysis works with.
+    """
+
+    filename = None
+    sizes = {}
+    """Sizes of the axes (x, y, c, z, t, v), axes that are not present in the file are left out"""
+
+    metadata = {}
+
+    def get_frame(self, v=0, t=0, z=0, c=0):
+        """Return a single (y,x) frame"""
+        raise NotImplementedError
+
+    def get_stack(self, v=0, t=0, c=0):
+        """Return all z slices of one series, time point and channel as a single (z,y,x) array"""
+        num_z = self.sizes.get('z', 1)
+        frame = self.get_frame(v, t, 0, c)
+        stack = np.empty((num_z,) + frame.shape, dtype=frame.dtype)
+        stack[0] = frame
+        for z in range(1, num_z):
+            stack[z] = self.get_frame(v, t, z, c)
+        return stack
+
+    def zstack(self, c=0, v=0, t=0):
+        """Return the z-stack of the given channel, series and time point"""
+        return ZStack(self, c=c, v=v if v is not None else 0, t=t)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class PimsFrameSource(FrameSource):
+    """Frame source for all file types that pims can open
+
+    pims readers keep the requested coordinates as state, so all reads are serialized with a lock
+    """
+
+    def __init__(self, filename, reader=None):
+        self.filename = filename
+        self.reader = reader if reader is not None else pims.open(filename)
+        self.sizes = dict(self.reader.sizes)
+        self.metadata = dict(getattr(self.reader, 'metadata', {}))
+        self._lock = threading.Lock()
+
+    def get_frame(self, v=0, t=0, z=0, c=0):
+        coords = {'v': v, 't': t, 'z': z, 'c': c}
+        with self._lock:
+            self.reader.bundle_axes = 'yx'
+            self.reader.iter_axes = ''
+            for axis, value in coords.items():
+                if axis in self.sizes:
+                    self.reader.default_coords[axis] = value
+            return np.asarray(self.reader[0])
+
+    def close(self):
+        self.reader.close()
+
+
+class ND2MemmapSource(FrameSource):
+    """Fast frame source for nd2 files that memory-maps the image data
+
+    The metadata and the location of all image chunks are read once with nd2reader, after which
+    frames are returned as read-only views into the memory-mapped file without any copying.
+    Like nd2reader, 16 bit images are assumed. The source can be pickled to be used in worker processes.
+    """
+
+    CHUNK_MAGIC = 0xabeceda
+
+    def __init__(self, filename):
+        self.filename = filename
+        with ND2Reader(filename) as reader:
+            self.sizes = dict(reader.sizes)
+            self.metadata = dict(reader.metadata)
+            label_map = reader.parser._label_map
+            num_groups = self.sizes.get('t', 1) * self.sizes.get('v', 1) * self.sizes.get('z', 1)
+            self._chunks = [label_map.get_image_data_location(i) for i in range(num_groups)]
+        self._open()
+
+    def _open(self):
+        self._mmap = np.memmap(self.filename, dtype=np.uint8, mode='r')
+        height, width = self.sizes['y'], self.sizes['x']
+        num_channels = max(len(self.metadata['channels']), 1)
+        self._images = [] # (offset, row length) of the image data of every image group
+        for location in self._chunks:
+            magic, name_length, data_length = struct.unpack("IIQ", self._mmap[location:location+16].tobytes())
+            if magic != self.CHUNK_MAGIC:
+                raise ValueError(f"{self.filename} seems to be corrupted")
+            # the chunk data starts with a timestamp (8 bytes), followed by the interleaved channels of all pixels
+            # rows can be padded, so the row length is determined from the size of the chunk
+            row_length = (data_length - 8) // 2 // height
+            if row_length < width*num_channels:
+                raise ValueError(f"Image data in {self.filename} is smaller than expected")
+            self._images.append((location + 16 + name_length + 8, row_length))
+        self._num_channels = num_channels
+
+    def __getstate__(self):
+        return {'filename': self.filename, 'sizes': self.sizes, 'metadata': self.metadata, '_chunks': self._chunks}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def _group_number(self, v, t, z):
+        return (t * self.sizes.get('v', 1) + v) * self.sizes.get('z', 1) + z
+
+    def get_frame(self, v=0, t=0, z=0, c=0):
+        offset, row_length = self._images[self._group_number(v, t, z)]
+        rows = np.ndarray((self.sizes['y'], row_length), dtype=np.uint16, buffer=self._mmap, offset=offset)
+        return rows[:, c:self.sizes['x']*self._num_channels:self._num_channels]
+
+    def close(self):
+        self._mmap = None
+        self._images = []
+
+
+class TiffSequenceSource(FrameSource):
+    """Frame source for a directory of single-page tif files, one file per channel and z slice
+
+    The channel and z index are read from the filenames (e.g. `image_c1_z012.tif`). This index and
+    the pixel size are determined once and cached until files are added, removed or changed.
+    Whole z-stacks are read with a thread pool. After calling `convert`, all frames are stored in a
+    single stack file in the cache directory, which is memory-mapped instead of reading the tif files.
+    """
+
+    CACHE_DIRECTORY = os.path.join(os.path.expanduser("~"), ".guvanalysis", "cache")
+
+    def __init__(self, pattern, cache_directory=None, max_workers=None):
+        self.filename = pattern
+        self.max_workers = max_workers
+        cache_directory = cache_directory or self.CACHE_DIRECTORY
+        cache_key = hashlib.sha1(os.path.abspath(pattern).encode()).hexdigest()[:16]
+        self.index_filename = os.path.join(cache_directory, f"{cache_key}-index.json")
+        self.stack_filename = os.path.join(cache_directory, f"{cache_key}-stack.npy")
+
+        files_hash = self._files_hash(glob.glob(pattern))
+        index = self._read_index()
+        converted = os.path.exists(self.stack_filename)
+        if index is None or index.get('files_hash') != files_hash:
+            # files were added, removed or changed (also when overwritten under the same name)
+            if converted: # the stack file belongs to an older set of files
+                os.remove(self.stack_filename)
+            index = self._build_index(files_hash)
+            os.makedirs(cache_directory, exist_ok=True)
+            self._write_index(index)
+        else:
+            converted = False # still valid, nothing to convert again
+        self._files = index['files']
+        self.sizes = index['sizes']
+        self.metadata = {'pixel_microns': index['pixel_microns']}
+        self._open()
+        if converted: # the files were converted before, so convert the new files as well
+            self.convert()
+
+    @property
+    def complete(self):
+        """Whether there is a file for every channel and z slice"""
+        return all(f is not None for channel in self._files for f in channel)
+
+    def _read_index(self):
+        if not os.path.exists(self.index_filename):
+            return None
+        with open(self.index_filename, "r") as indexfile:
+            return json.load(indexfile)
+
+    def _write_index(self, index):
+        with open(self.index_filename, "w") as indexfile:
+            json.dump(index, indexfile)
+
+    @staticmethod
+    def _files_hash(filenames):
+        """Hash of the names, sizes and modification times of the files"""
+        sha = hashlib.sha1()
+        for filename in sorted(filenames):
+            stat = os.stat(filename)
+            sha.update(f"{filename}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+        return sha.hexdigest()
+
+    def _build_index(self, files_hash):
+        filenames = sorted(glob.glob(self.filename))
+        if not filenames:
+            raise IOError(f"No files found matching {self.filename}")
+        indices = np.zeros((len(filenames), 2), dtype=int) # (c, z) of every file
+        for i, filename in enumerate(filenames):
+            for axis, index in re.findall(r"(c|z)(\d+)", os.path.basename(filename)):
+                indices[i, 0 if axis == 'c' else 1] = int(index)
+        indices -= indices.min(axis=0)
+        num_c, num_z = indices.max(axis=0) + 1
+        files = [[None]*num_z for _ in range(num_c)]
+        for (c, z), filename in zip(indices, filenames):
+            files[c][z] = filename
+
+        with Image.open(filenames[0]) as im: # image size and pixel size from the first file
+            width, height = im.size
+            resolution = im.info.get('resolution') # saved in tiff info by imagej
+        pixel_microns = 1./resolution[0] if resolution and resolution[0] else None
+        sizes = {'c': int(num_c), 'z': int(num_z), 'y': height, 'x': width}
+        return {'files_hash': files_hash, 'files': files,
+                'sizes': sizes, 'pixel_microns': pixel_microns}
+
+    def _open(self):
+        self._stack = np.load(self.stack_filename, mmap_mode='r') if os.path.exists(self.stack_filename) else None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_stack']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def get_frame(self, v=0, t=0, z=0, c=0):
+        if self._stack is not None:
+            return self._stack[c, z]
+        with Image.open(self._files[c][z]) as im:
+            return np.asarray(im)
+
+    def get_stack(self, v=0, t=0, c=0):
+        if self._stack is not None:
+            return np.array(self._stack[c])
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return np.stack(list(executor.map(lambda z: self.get_frame(c=c, z=z), range(self.sizes['z']))))
+
+    def convert(self):
+        """Store all frames in a single stack file that is used instead of the tif files from now on"""
+        if self._stack is not None:
+            return self.stack_filename
+        tmpfilename = self.stack_filename.replace(".npy", ".tmp.npy")
+        first = self.get_frame()
+        stack = np.lib.format.open_memmap(tmpfilename, mode="w+", dtype=first.dtype,
+                                          shape=(self.sizes['c'], self.sizes['z'], self.sizes['y'], self.sizes['x']))
+        for c in range(self.sizes['c']):
+            stack[c] = self.get_stack(c=c)
+        stack.flush()
+        del stack
+        os.replace(tmpfilename, self.stack_filename)
+        self._open()
+        return self.stack_filename
+
+    def close(self):
+        self._stack = None
+
+
+@Slicerator.from_class
+class ZStack:
+    """Immutable z-stack of a single channel, series and time point of a frame source
+
+    Behaves like the pims sequences used before (indexing, `len`, `sizes`, `metadata`, pims pipelines),
+    but never changes the state of the underlying source, so it can safely be shared between threads
+    """
+
+    def __init__(self, source: FrameSource, c=0, v=0, t=0):
+        self.source = source
+        self.c, self.v, self.t = c, v, t
+
+    def __len__(self):
+        return self.source.sizes.get('z', 1)
+
+    def __getitem__(self, z):
+        return self.source.get_frame(v=self.v, t=self.t, z=z, c=self.c)
+
+    @property
+    def sizes(self):
+        return self.source.sizes
+
+    @property
+    def metadata(self):
+        return self.source.metadata
+
+    def with_channel(self, c):
+        """Return the same z-stack for another channel"""
+        return ZStack(self.source, c=c, v=self.v, t=self.t)
+
+    def to_array(self):
+        """Read the whole z-stack at once as a (z,y,x) array"""
+        return self.source.get_stack(v=self.v, t=self.t, c=self.c)
+
+
+def open_frame_source(filename):
+    """Open a file with the fastest frame source that supports it
+
+    Args:
+        filename (str): nd2 file, or pattern of tif files (e.g. `dir/*.tif`) with the channel and z index in the filenames
+
+    Returns:
+        FrameSource: the opened frame source
+    """
+    if filename.endswith(".tif"):
+        return TiffSequenceSource(filename)
+    if filename.endswith(".nd2"):
+        try:
+            return ND2MemmapSource(filename)
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Could not memory-map {filename} ({e}), falling back to the slower reader")
+    return PimsFrameSource(filename)
@@ -6,17 +6,19 @@ import matplotlib.pyplot as plt
 plt.rcParams['image.cmap'] = 'gray'
 from matplotlib.figure import Figure
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from pims.image_sequence import ImageSequenceND
+from .framesource import ZStack
 import nd2reader
 import pims
 import pandas as pd
 from pandas import DataFrame
-from datetime import datetime
 import os
+from dataclasses import fields
 from .parameters import ParameterList
 from .guvgui import GUV_GUI
 from .guvfinder import GUV_finder
 from .tkhelpers import CreateToolTip
+from .manifest import RunManifest
+from .output import store_results
 
 
 class GUV_Control:
@@ -25,7 +27,7 @@ class GUV_Control:
     Uses the GUV_GUI and GUV_finder
     """
 
-    def __init__(self, stack: ImageSequenceND, parameters: ParameterList, data: pd.DataFrame = None):
+    def __init__(self, stack: ZStack, parameters: ParameterList, data: pd.DataFrame = None, manifest: RunManifest = None):
         """Initialize the GUI
         """
         self.stack = stack
@@ -33,12 +35,8 @@ class GUV_Control:
         # self.stack.iter_axes = "z" # iterate over only z axis, channel should be set in app.py
         self.params = parameters
         self.adjustable_params = self.params.get_adjustable_variables()
+        self.manifest = manifest # keeps track of finished series and stages (None to disable)
 
-        filepath_without_ext = self.params.filename.replace(".nd2","")
-        filepath_without_ext = self.params.filename.replace("*.tif","")
-        date_suffix = datetime.now().strftime("%y%m%d%H%M")
-        self.resultsfilename = f"{filepath_without_ext}_{'s%02d-' % self.params.series if self.params.series is not None else ''}GUVdata_{date_suffix}.csv"
-        self.paramsfilename = f"{filepath_without_ext}_{'s%02d-' % self.params.series if self.params.series is not None else ''}GUVparams_{date_suffix}.json"
 
         self.removed_GUVs = False # for determining whether user has changed data using scroller
 
@@ -111,6 +109,7 @@ class GUV_Control:
         self.statscanvas.get_tk_widget().grid(column=num_cols, row=1, rowspan=num_rows-1, sticky='nswe')
 
         self.guvfinder = GUV_finder(self.stack, self.params, self.statscanvas, self.statsfig)
+        self.guvfinder.manifest = self.manifest
         if self.guv_data is not None:
             self.guvfinder.renew(self.guv_data)
             self.fill_results_labels()
@@ -120,7 +119,7 @@ class GUV_Control:
 
         self.scrolllabel = tk.Label(self.root, bg="white", height=3, text="""Use your scrollwheel to scroll through the stack
         All GUVs are represented with blue circles, while the yellow circles indicate GUVs in the current frame
-        Right click near a yellow circle to remove it""")
+        Right click near a yellow circle to remove it, left click on a missed GUV to add it""")
         self.scrolllabel.grid(column=num_cols, row=0, ipady=2)
 
         self.scrollfig = Figure(figsize=(6,6), dpi=100)
@@ -128,7 +127,7 @@ class GUV_Control:
         self.scrollcanvas.get_tk_widget().grid(column=num_cols, row=1, rowspan=num_rows-1, sticky='nswe')
         num_cols += 1
 
-        self.scroller = GUV_GUI(self.stack, self.guv_data, self.scrollcanvas, self.scrollfig, self.update_stats)      
+        self.scroller = GUV_GUI(self.stack, self.guv_data, self.scrollcanvas, self.scrollfig, self.update_stats, self.guvfinder)
 
         self.statusbar = tk.Label(self.root, text='Ready for performing analysis...', bd=1, relief=tk.SUNKEN,bg='white', anchor = tk.W)  
         self.statusbar.grid(column=0, row=num_rows, columnspan=num_cols, sticky='swe')
@@ -144,8 +143,9 @@ class GUV_Control:
         self.statusbar.update()
         self.removed_GUVs = False
         # updating variables 
+        types = {field.name: field.type for field in fields(ParameterList)}
         for var in self.pspinners:
-            val = float(self.pspinners[var].get())
+            val = types[var](float(self.pspinners[var].get())) # e.g. track_z_thresh stays an int
             setattr(self.params, var, val)
         
         self.guvfinder.run_analysis()
@@ -162,9 +162,10 @@ class GUV_Control:
 
     def update_stats(self):
         self.removed_GUVs = True
+        added = len(self.scroller.get_data()) > len(self.guv_data)
         self.guv_data = self.scroller.get_data()
-        self.statusbar['text'] = 'GUV was removed successfully and statistics were updated'
-        self.guvfinder.renew(self.guv_data)
+        self.statusbar['text'] = f"GUV was {'added' if added else 'removed'} successfully and statistics were updated"
+        self.guvfinder.renew(self.guv_data, incremental=True)
         self.fill_results_labels()
 
     def show_help(self):
@@ -182,8 +183,8 @@ class GUV_Control:
         if self.guv_data.empty:
             print("No data to store, empty csv file will be written")
         
-        print(f"Data for {len(self.guv_data)} GUVs stored in {self.resultsfilename}")
-        self.guv_data.to_csv(self.resultsfilename, index=False, header=True)
-        self.params.to_json(self.paramsfilename)
+        # written in the background (and marked as finished in the manifest when done), the files are flushed before python exits
+        resultsfilename, _ = store_results(self.params, self.guv_data, self.manifest, selection=self.removed_GUVs)
+        print(f"Data for {len(self.guv_data)} GUVs stored in {resultsfilename}")
 
         self.root.quit()        
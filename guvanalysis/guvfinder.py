@@ -10,27 +10,39 @@ import numpy as np
 import pandas as pd
 from nd2reader import ND2Reader # for handling the nd2 file with PIMS
 import pims # for loading files
-from pims.image_sequence import ImageSequenceND
 from PIL import Image # for image processing
-from numpy.linalg import norm
+from dataclasses import replace
 from .parameters import ParameterList
+from .framesource import ZStack, open_frame_source
+from .regionstore import RegionStore
+from . import fastdetect
+from . import sharedframes
+from .sharedframes import SharedFrameBuffer, FrameDescriptor, attach
 
 from skimage.filters import gaussian
 from skimage.measure import label,regionprops,regionprops_table
 from skimage.feature import canny
 from skimage.util import img_as_ubyte,img_as_uint
 from scipy import ndimage as ndi
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import threading
 
 class helpers:
     @staticmethod
     @pims.pipeline
     def as_8bit(frame): # scale intensities to 8bit image
-        imin = frame.min()
-        imax = frame.max()
+        return helpers.scale_to_8bit(frame, frame.min(), frame.max())
+        # return img_as_uint(np.array(frame,dtype=np.uint16))
+
+    @staticmethod
+    def scale_to_8bit(frame, imin, imax):
+        """Scale (a part of) a frame to 8 bit, such that `imin` becomes 0 and `imax` 255 (see `as_8bit`)"""
         a = (255 - 0) / (imax - imin)
         b = 255 - a * imax
         return (a * frame + b).astype(np.uint8)
-        # return img_as_uint(np.array(frame,dtype=np.uint16))
 
     @staticmethod
     def bounded_range(orig_range, min_val, max_val): # remove all items from a range that are outside (min,max)
@@ -43,7 +55,228 @@ class helpers:
     @staticmethod
     @pims.pipeline
     def process_find_edges(frame, params):
-        return ndi.binary_fill_holes(canny(frame, sigma=params.blur_radius, low_threshold=20, high_threshold=50))
+        return ndi.binary_fill_holes(canny(frame, sigma=params.blur_radius, low_threshold=params.canny_low_threshold, high_threshold=params.canny_high_threshold))
+
+    @staticmethod
+    def find_edges_and_labels(frame, params):
+        """Filled edge mask and labelled regions of an 8-bit frame
+
+        Uses the compiled kernel of `fastdetect` if `params.compiled_detection` is set and numba
+        is installed, otherwise `process_find_edges` and `label` (both give the same result)
+
+        Returns:
+            (np.ndarray, np.ndarray): the filled mask and the labels
+        """
+        if params.compiled_detection and fastdetect.available():
+            return fastdetect.find_edges_and_labels(frame, params.blur_radius, params.canny_low_threshold, params.canny_high_threshold)
+        mask = helpers.process_find_edges(frame, params)
+        return mask, label(mask)
+
+    @staticmethod
+    def gradient_histogram(frames, params, max_frames=8, max_size=2048):
+        """Histogram of the gradient magnitude (as used by the edge detection) of a stack
+
+        Only up to `max_frames` frames, spread over the stack, are used, and of large frames
+        (e.g. tiled mosaics) only the central `max_size` x `max_size` px
+
+        Returns:
+            (np.ndarray, np.ndarray): the counts and the bin edges (bins of 1, on the scale of the 8-bit frames)
+        """
+        indices = np.unique(np.linspace(0, len(frames)-1, min(len(frames), max_frames)).astype(int))
+        bins = np.arange(0., 4*255*np.sqrt(2) + 2) # the sobel gradient of an 8-bit image is at most 4*255 in both directions
+        counts = np.zeros(len(bins)-1, dtype=np.int64)
+        for i in indices:
+            frame = np.asarray(frames[i])
+            y0, x0 = max((frame.shape[0] - max_size)//2, 0), max((frame.shape[1] - max_size)//2, 0)
+            smoothed = ndi.gaussian_filter(frame[y0:y0+max_size, x0:x0+max_size].astype(float), params.blur_radius)
+            magnitude = np.hypot(ndi.sobel(smoothed, axis=0), ndi.sobel(smoothed, axis=1))
+            counts += np.histogram(magnitude, bins)[0]
+        return counts, bins
+
+    @staticmethod
+    def otsu_threshold(counts, bin_edges):
+        """Threshold that maximizes the between-class variance of a histogram (Otsu's method)"""
+        centers = (bin_edges[:-1] + bin_edges[1:])/2
+        weight_below = np.cumsum(counts)
+        weight_above = np.cumsum(counts[::-1])[::-1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_below = np.cumsum(counts*centers)/weight_below
+            mean_above = (np.cumsum((counts*centers)[::-1])/weight_above[::-1])[::-1]
+            variance = weight_below[:-1]*weight_above[1:]*(mean_below[:-1] - mean_above[1:])**2
+        return centers[np.nanargmax(variance)] if np.any(variance > 0) else centers[0]
+
+    @staticmethod
+    def edge_thresholds(frames, params):
+        """Low and high threshold of the edge detection for a stack
+
+        Returns the fixed thresholds of `params`, unless `params.auto_threshold` is set. The high
+        threshold is then derived from the histogram of the gradient magnitude of the stack (a
+        percentile of it, or the Otsu threshold), the low threshold is `auto_threshold_ratio`
+        times the high threshold.
+
+        Returns:
+            (float, float): low and high threshold
+        """
+        if not params.auto_threshold:
+            return params.canny_low_threshold, params.canny_high_threshold
+        counts, bins = helpers.gradient_histogram(frames, params)
+        if params.auto_threshold == 'otsu':
+            high = helpers.otsu_threshold(counts, bins)
+        elif params.auto_threshold == 'percentile':
+            high = bins[1:][np.searchsorted(np.cumsum(counts), params.auto_threshold_percentile/100*counts.sum())]
+        else:
+            raise ValueError(f"Unknown auto_threshold {params.auto_threshold}, use 'percentile' or 'otsu'")
+        return params.auto_threshold_ratio*high, high
+
+    @staticmethod
+    def open_stack(params, t=0):
+        """Open the file in `params` as a z-stack of the selected channel, series and time point"""
+        return open_frame_source(params.filename).zstack(c=params.channel, v=params.series, t=t)
+
+    @staticmethod
+    def regions_from_mask(mask):
+        """Measure all regions in a filled mask
+
+        Args:
+            mask (np.ndarray): filled binary mask as returned by `process_find_edges`
+
+        Returns:
+            pd.DataFrame: table with the columns area, x, y, ar and r (in px) for every region
+        """
+        return helpers.regions_from_labels(label(mask))
+
+    @staticmethod
+    def regions_from_labels(labels, extra_properties=()):
+        """Measure all regions in a label image, see `regions_from_mask`
+
+        Args:
+            labels (np.ndarray): label image
+            extra_properties (tuple): additional properties passed to `regionprops_table`
+        """
+        frame_regions = regionprops_table(labels, properties = ('centroid', 'major_axis_length', 'minor_axis_length', 'area') + tuple(extra_properties))
+        # rename columns and delete old ones
+        frame_regions['x'] = frame_regions['centroid-1']
+        frame_regions['y'] = frame_regions['centroid-0']
+        del frame_regions['centroid-0']
+        del frame_regions['centroid-1']  
+
+        # initialize dataframe for easier merging and data storage  
+        frame_regions_df = pd.DataFrame(frame_regions)
+        frame_regions_df['minor_axis_length'].apply(lambda x: 1. if x == 0. else x)
+        frame_regions_df['ar'] = frame_regions_df['major_axis_length']/frame_regions_df['minor_axis_length']
+        frame_regions_df = frame_regions_df.drop(columns = ['minor_axis_length', 'major_axis_length'])
+        frame_regions_df['r'] = np.sqrt(frame_regions_df['area']/np.pi)
+        return frame_regions_df
+
+    @staticmethod
+    def find_regions_tiled(frame, params, max_workers=None, intensity_range=None):
+        """Find the regions in a large frame by processing overlapping tiles in parallel
+
+        Every tile is padded with `params.tile_overlap` px on all sides and a region is only
+        kept by the tile that contains its centroid. Regions that touch the border of a padded
+        tile (and not the border of the frame) are cut off and therefore dropped, so GUVs
+        with a diameter up to `tile_overlap` give the same regions as processing the full frame.
+
+        Args:
+            frame (np.ndarray): 8-bit frame, or the raw frame if `intensity_range` is given
+            params (ParameterList): parameters, `tile_size` and `tile_overlap` set the tiling
+            max_workers (int): number of tiles processed at the same time (number of cpus if None)
+            intensity_range ((number, number)): minimum and maximum of the raw frame, every padded tile is
+                then scaled to 8 bit like `as_8bit` does for the full frame, without converting the full frame at once
+
+        Returns:
+            pd.DataFrame: the same table as `regions_from_mask` would give for the full frame
+        """
+        ny, nx = frame.shape
+        # padding also covers the gaussian kernel of the edge detection
+        pad = int(params.tile_overlap) + int(np.ceil(4*params.blur_radius)) + 1
+        tile = int(params.tile_size)
+
+        def process_tile(origin):
+            y0, x0 = origin
+            y1, x1 = min(y0+tile, ny), min(x0+tile, nx) # the part of the frame this tile is responsible for
+            ya, xa = max(y0-pad, 0), max(x0-pad, 0)
+            yb, xb = min(y1+pad, ny), min(x1+pad, nx)
+            part = frame[ya:yb, xa:xb]
+            if intensity_range is not None:
+                part = helpers.scale_to_8bit(part, *intensity_range)
+            labels = helpers.find_edges_and_labels(part, params)[1]
+            df = helpers.regions_from_labels(labels, extra_properties=('bbox',))
+            df['x'] += xa
+            df['y'] += ya
+            keep = (df['y'] >= y0) & (df['y'] < y1) & (df['x'] >= x0) & (df['x'] < x1)
+            keep &= ~(((df['bbox-0'] == 0) & (ya > 0)) | ((df['bbox-1'] == 0) & (xa > 0)) |
+                      ((df['bbox-2'] == yb-ya) & (yb < ny)) | ((df['bbox-3'] == xb-xa) & (xb < nx)))
+            # position of the first pixel of every region, to sort the regions like `label` would for the full frame
+            values, first_pixel = np.unique(labels.ravel(), return_index=True)
+            first_pixel = first_pixel[values > 0] # skip the background
+            df['first_pixel'] = (first_pixel // labels.shape[1] + ya)*nx + first_pixel % labels.shape[1] + xa
+            return df[keep].drop(columns=['bbox-0', 'bbox-1', 'bbox-2', 'bbox-3'])
+
+        origins = [(y0, x0) for y0 in range(0, ny, tile) for x0 in range(0, nx, tile)]
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            tiles = list(executor.map(process_tile, origins))
+        regions = pd.concat(tiles, ignore_index=True).sort_values('first_pixel', kind='stable')
+        return regions.drop(columns=['first_pixel']).reset_index(drop=True)
+
+    @staticmethod
+    def detect_regions_shared(frame: FrameDescriptor, mask: FrameDescriptor, params):
+        """Detect the regions in a frame in shared memory (runs in a worker process of `GUV_finder.detect_regions`)
+
+        The filled mask is written into the shared memory of `mask` (skipped if None), only the
+        table of regions is sent back
+
+        Returns:
+            dict: the columns x, y, r, area and ar of the regions
+        """
+        frame = attach(frame)
+        if params.tile_size:
+            frame_regions_df = helpers.find_regions_tiled(frame, params)
+        else:
+            filled, labels = helpers.find_edges_and_labels(frame, params)
+            if mask is not None:
+                attach(mask)[...] = filled
+            frame_regions_df = helpers.regions_from_labels(labels)
+        return {name: frame_regions_df[name].to_numpy() for name in ('x', 'y', 'r', 'area', 'ar')}
+
+    @staticmethod
+    def reduce_tracks(regions):
+        """Compute the statistics of all tracks in a single pass
+
+        The points are sorted once by track (and by decreasing area within a track), after which
+        all statistics are computed with reductions over the segments of the sorted arrays
+
+        Args:
+            regions (RegionStore): linked points, with the `guv_id` column
+
+        Returns:
+            (dict, np.ndarray): per track the guv_id, num_points, best_index (index of the point with the largest area),
+                z_min, z_max (first and last frame), area_mean and r_std; and per point the number of points of its track
+        """
+        guv_id = regions['guv_id']
+        if len(guv_id) == 0:
+            empty = np.zeros(0, dtype=int)
+            return {name: empty for name in ('guv_id', 'num_points', 'best_index', 'z_min', 'z_max', 'area_mean', 'r_std')}, empty
+        order = np.lexsort((-regions['area'], guv_id))
+        sorted_ids = guv_id[order]
+        starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]]) # first point of every track
+        counts = np.diff(np.r_[starts, len(order)])
+
+        r = regions['r'][order].astype(float)
+        r_mean = np.add.reduceat(r, starts)/counts
+        tracks = {
+            'guv_id': sorted_ids[starts],
+            'num_points': counts,
+            'best_index': order[starts],
+            'z_min': np.minimum.reduceat(regions['frame'][order], starts),
+            'z_max': np.maximum.reduceat(regions['frame'][order], starts),
+            'area_mean': np.add.reduceat(regions['area'][order].astype(float), starts)/counts,
+            'r_std': np.sqrt(np.maximum(np.add.reduceat(r**2, starts)/counts - r_mean**2, 0)),
+        }
+
+        num_points = np.empty(len(order), dtype=int)
+        num_points[order] = np.repeat(counts, counts)
+        return tracks, num_points
 
     @staticmethod
     def image_subregion(frame, xlims=[0,100], ylims=[0,100], circular=False):
@@ -90,7 +323,7 @@ class helpers:
 
 class GUV_finder:
 
-    def __init__(self, stack: ImageSequenceND, parameters: ParameterList, canvas, figure):
+    def __init__(self, stack: ZStack, parameters: ParameterList, canvas=None, figure=None):
         self.stack = stack
         # self.stack.bundle_axes = 'yx' # have only yx data in one frame
         # self.stack.iter_axes = 'z' # iterate over the z axis
@@ -99,149 +332,252 @@ class GUV_finder:
         #     self.stack.default_coords['v'] = parameters.series # select the correct channel
         # self.stack.default_coords['t'] = 0 # single time
         # self.metadata = self.stack.metadata
-        if hasattr(self.stack, 'metadata'):
+        if self.stack.metadata.get('pixel_microns'):
             self.metadata = self.stack.metadata
-        else:
+        else: # e.g. tif files
             self.metadata = {'pixel_microns': parameters.pixel_microns}
         print(self.metadata)
         self.frames = helpers.as_8bit(stack)
 
         self.params = parameters
+        if parameters.compiled_detection and not fastdetect.available():
+            print("The compiled detection requires numba, which is not installed, using the slower skimage functions")
+        if parameters.detection_workers > 1 and not sharedframes.available():
+            print("Detection in worker processes requires python 3.8 or newer, the frames are processed in this process")
 
         self.guv_data = pd.DataFrame(columns=['x','y','frame','r','intensity','r_um']) # dummy data frame
 
-        self.canvas = canvas
+        self.manifest = None # RunManifest to store and reuse the outputs of the detection and linking stages
+        self.snapshot_filename = "points_snapshot.csv" # all linked points are stored here for inspection (None to disable)
+
+        self.canvas = canvas # canvas and figure are None when running without GUI (e.g. time-lapse mode)
         self.figure = figure
 
     def run_analysis(self):
-        self.find_GUVs_in_all_frames()
-        self.link_GUV_points()
+        if self.manifest is not None:
+            self.find_and_link_GUVs_with_checkpoints()
+        else:
+            self.find_GUVs_in_all_frames()
+            self.link_GUV_points()
         self.get_GUVs_from_linked_points()
         self.determine_GUV_intensities()
-        self.make_plots()
+        if self.figure is not None:
+            self.make_plots()
 
     def find_GUVs_in_all_frames(self):
+        self.frames_regions = helpers.filter_GUV_dataframe(self.detect_regions(), self.params)
+
+    def find_and_link_GUVs_with_checkpoints(self):
+        """Same as `find_GUVs_in_all_frames` followed by `link_GUV_points`, but reuses the
+        outputs of these stages from the manifest if they were computed before with the same parameters"""
+        tracks = self.manifest.load_stage(self.params, 'tracks')
+        if tracks is not None:
+            self.frames_regions = RegionStore.from_dataframe(tracks)
+            return
+        regions = self.manifest.load_stage(self.params, 'regions')
+        if regions is None:
+            regions = self.detect_regions()
+            self.manifest.save_stage(self.params, 'regions', regions.to_dataframe())
+        else:
+            regions = RegionStore.from_dataframe(regions)
+        self.frames_regions = helpers.filter_GUV_dataframe(regions, self.params)
+        self.link_GUV_points()
+        self.manifest.save_stage(self.params, 'tracks', self.frames_regions.to_dataframe())
+
+    def detect_regions(self):
+        """Detect the regions in all frames, without filtering them on size and shape
+
+        Only `blur_radius`, the edge thresholds (and the tiling) affect the result, so the result can be reused for other parameters
+
+        Returns:
+            RegionStore: regions (frame, x, y, r, area, ar) of all frames
+        """
+        # thresholds are determined once for the whole stack and then used for every frame
+        low, high = self.edge_thresholds = helpers.edge_thresholds(self.frames, self.params)
+        params = replace(self.params, canny_low_threshold=low, canny_high_threshold=high, auto_threshold=None)
+        if params.detection_workers > 1 and sharedframes.available():
+            return self.detect_regions_in_processes(params)
         self.frames_filled = []
-        dfcols = ('frame', 'x', 'y', 'r', 'area', 'ar')
-        self.frames_regions = pd.DataFrame(columns=dfcols)
-        for i,frame in enumerate(self.frames):
-            self.frames_filled.append(helpers.process_find_edges(frame, self.params))
-            frame_regions = regionprops_table(label(self.frames_filled[i]), properties = ('centroid', 'major_axis_length', 'minor_axis_length', 'area'))
-            if frame_regions:
-                # rename columns and delete old ones
-                frame_regions['x'] = frame_regions['centroid-1']
-                frame_regions['y'] = frame_regions['centroid-0']
-                del frame_regions['centroid-0']
-                del frame_regions['centroid-1']  
-
-                # initialize dataframe for easier merging and data storage  
-                frame_regions_df = pd.DataFrame(frame_regions)
-                frame_regions_df['minor_axis_length'].apply(lambda x: 1. if x == 0. else x)
-                frame_regions_df['ar'] = frame_regions_df['major_axis_length']/frame_regions_df['minor_axis_length']
-                frame_regions_df = frame_regions_df.drop(columns = ['minor_axis_length', 'major_axis_length'])
-                frame_regions_df['r'] = np.sqrt(frame_regions_df['area']/np.pi)
-                frame_regions_df['frame'] = i
-
-                # append to dataframe that holds all GUVs
-                self.frames_regions = self.frames_regions.append(helpers.filter_GUV_dataframe(frame_regions_df, self.params),
-                                                                 ignore_index=True)
-    def link_GUV_points(self):
-        points = np.array(self.frames_regions[['x','y','frame']]) # only coords
+        frames_regions = RegionStore()
+        for i in range(len(self.frames)):
+            if params.tile_size:
+                # large images are processed in tiles, the filled masks are not stored to keep memory usage bounded,
+                # and the tiles are scaled to 8 bit one by one
+                frame = np.asarray(self.stack[i])
+                frame_regions_df = helpers.find_regions_tiled(frame, params, intensity_range=(frame.min(), frame.max()))
+            else:
+                mask, labels = helpers.find_edges_and_labels(self.frames[i], params)
+                self.frames_filled.append(mask)
+                frame_regions_df = helpers.regions_from_labels(labels)
+            frames_regions.append(frame=i, **{name: frame_regions_df[name].to_numpy() for name in ('x', 'y', 'r', 'area', 'ar')})
+        return frames_regions
+
+    def detect_regions_in_processes(self, params):
+        """Same as `detect_regions`, but the frames are processed by a pool of `params.detection_workers` worker processes
+
+        The 8-bit frames are placed in shared memory once and the workers write the filled masks
+        into shared memory as well, so only small descriptors and the tables of regions are sent
+        between the processes instead of pickled frames and masks
+        """
+        num_frames = len(self.frames)
+        shape = np.shape(self.stack[0])
+        store_masks = not params.tile_size # see `detect_regions`
+        with SharedFrameBuffer(num_frames, shape) as frames, SharedFrameBuffer(num_frames if store_masks else 0, shape, dtype=bool) as masks:
+            for i in range(num_frames):
+                if params.tile_size: # scaled to 8 bit in blocks of rows, like the tiles in `detect_regions`
+                    frame = np.asarray(self.stack[i])
+                    imin, imax = frame.min(), frame.max()
+                    for y0 in range(0, shape[0], params.tile_size):
+                        frames.array[i, y0:y0+params.tile_size] = helpers.scale_to_8bit(frame[y0:y0+params.tile_size], imin, imax)
+                else:
+                    frames.array[i] = self.frames[i]
+            with ProcessPoolExecutor(max_workers=params.detection_workers) as executor:
+                results = list(executor.map(helpers.detect_regions_shared,
+                    [frames.descriptor(i) for i in range(num_frames)],
+                    [masks.descriptor(i) if store_masks else None for i in range(num_frames)],
+                    [params]*num_frames))
+            self.frames_filled = list(masks.array.copy()) # copied, since the shared memory is released here
+        frames_regions = RegionStore()
+        for i, columns in enumerate(results):
+            frames_regions.append(frame=i, **columns)
+        return frames_regions
+
+    def link_GUV_points(self, regions=None):
+        """Link the points of all frames that belong to the same GUV (sets the `guv_id` column)
+
+        Points in different frames are neighbours if they are at most `track_xy_thresh` px apart in the
+        xy plane and at most `track_z_thresh` frames apart. All points that are connected through
+        neighbours get the same id, points without neighbours get -1.
+        """
+        regions = self.frames_regions if regions is None else regions # other regions are linked by `find_GUV_at`
+        points = np.column_stack([regions[c] for c in ('x','y','frame')]).astype(float) # only coords
         num_points = len(points)
 
-        # initialize arrays for storing distances in xy plane and z separately (as z corresponds to frame)
-        xydistances = np.zeros(shape=(num_points,num_points))
-        zdistances = np.zeros(shape=(num_points,num_points))
-
-        for i in range(num_points-1):
-            for j in range(i,num_points):
-                xydist = norm(points[i,:2] - points[j,:2])
-                zdist = norm(points[i,2] - points[j,2])
-                xydistances[i,j] = xydist
-                zdistances[i,j] = zdist
-
-        zmask = zdistances<=self.params.track_z_thresh
-        samemask = zdistances != 0.
-        xymask = xydistances<=self.params.track_xy_thresh
-        valid_neighbours = zmask & samemask & xymask
-        pairs = np.transpose((valid_neighbours).nonzero()) # create list of pairs of indices that are neighbours
-        # outputs [(1,2),(2,3),(4,5),...] for all points that are classified as neighbours on the above criterea
-        
+        # pairs of points that are close in the xy plane, of which only the pairs that are also close in z (but not in the same frame) are kept
+        pairs = cKDTree(points[:,:2]).query_pairs(self.params.track_xy_thresh, output_type='ndarray').reshape(-1, 2)
+        zdistances = np.abs(points[pairs[:,0],2] - points[pairs[:,1],2])
+        pairs = pairs[(zdistances != 0.) & (zdistances <= self.params.track_z_thresh)]
+
         # we need to link all points that have common neighbours
-        # e.g. if 1 neighbours 2 and 2 neighbours 3, we need to make a list containing [1,2,3]
-        labels = {}
-        maxlabel = 0
-        curlabel = False
-        for i,pair in enumerate(pairs):
-            for list_label,list_items in labels.items():
-                if pair[0] in list_items or pair[1] in list_items: # see if either of the two indices is already present in some list
-                    curlabel = list_label
-                    continue # we do not need to look further once we found one occurence
-            
-            if curlabel is not False: # add both items to the list in which at least one was already present
-                labels[curlabel].append(pair[0])
-                labels[curlabel].append(pair[1])
-            else: # create new list
-                curlabel = maxlabel
-                labels[curlabel] = list(pair)
-                maxlabel = maxlabel+1
-
-            for j in range(i,len(pairs)): # look for other occurrences with these indices in all other pairs
-                if pair[0] in pairs[j] or pair[1] in pairs[j]:
-                    labels[curlabel].append(pairs[j][0])
-                    labels[curlabel].append(pairs[j][1])            
-            
-            labels[curlabel] = list(np.unique(labels[curlabel])) # remove duplicates
-            curlabel = False # reset label
-
-        # make the inverse array, e.g. {point_index: label, point2_index: label2, ...}
-        inv_classifications = {}
-        for classification,pointlist in labels.items():
-            for p in pointlist:
-                inv_classifications[p] = classification
-
-        # add missing points
-        for i in range(len(points)):
-            if not i in inv_classifications:
-                inv_classifications[i] = -1 # assign label -1 to all points that are on their own
-        
-        inv_classifications_sort = dict(sorted(inv_classifications.items())) # sort the dictonairy by key
-        self.frames_regions['guv_id'] = list(inv_classifications_sort.values()) # assign the labels as 'guv_id' column
+        # e.g. if 1 neighbours 2 and 2 neighbours 3, the points 1, 2 and 3 form one GUV
+        neighbours = coo_matrix((np.ones(len(pairs)), (pairs[:,0], pairs[:,1])), shape=(num_points, num_points))
+        components = connected_components(neighbours, directed=False)[1]
+        linked = np.zeros(num_points, dtype=bool)
+        linked[pairs.ravel()] = True
+        guv_id = np.full(num_points, -1, dtype=int) # label -1 for all points that are on their own
+        guv_id[linked] = np.unique(components[linked], return_inverse=True)[1]
+        regions['guv_id'] = guv_id
 
     def get_GUVs_from_linked_points(self):
-        self.frames_regions['num_points'] = self.frames_regions.groupby(['guv_id'])['guv_id'].transform(len) # number of points corresponding to a certain GUV
-        self.frames_regions.to_csv("points_snapshot.csv", index=False, header=True)
-        self.frames_regions = self.frames_regions[(self.frames_regions['num_points'] >= self.params.track_min_length) & (self.frames_regions['guv_id'] != -1)].copy()
-        self.guv_data = self.frames_regions.sort_values('area', ascending=False).drop_duplicates(['guv_id']) # sort by area and use only the one with largest area
+        regions = self.frames_regions
+        tracks, regions['num_points'] = helpers.reduce_tracks(regions) # number of points corresponding to a certain GUV
+        if self.snapshot_filename: # written in the background, such that the analysis does not wait for it
+            threading.Thread(target=regions.to_dataframe().to_csv, args=(self.snapshot_filename,), kwargs={'index': False, 'header': True}).start()
+
+        valid_tracks = (tracks['num_points'] >= self.params.track_min_length) & (tracks['guv_id'] != -1)
+        self.frames_regions = regions[(regions['num_points'] >= self.params.track_min_length) & (regions['guv_id'] != -1)]
+        best = tracks['best_index'][valid_tracks]
+        order = np.argsort(-regions['area'][best], kind='stable') # sort by area and use only the one with largest area
+        self.guv_data = regions[best[order]].to_dataframe()
+        for name in ('z_min', 'z_max', 'area_mean', 'r_std'):
+            self.guv_data[name] = tracks[name][valid_tracks][order]
+        self.guv_data['r_um'] = self.guv_data['r']*self.metadata['pixel_microns']
 
     def determine_GUV_intensities(self):
-        self.stack.default_coords['c'] = self.params.intensity_channel
+        intensity_frames = helpers.as_8bit(self.stack.with_channel(self.params.intensity_channel))
         intensities = []
         for _,guv in self.guv_data.iterrows():
-            intensities.append(helpers.scaled_GUV_intensity(self.frames[guv['frame']], {'x': guv['x'], 'y': guv['y'], 'r': np.ceil(guv['r']).astype(int)}))
+            intensities.append(helpers.scaled_GUV_intensity(intensity_frames[int(guv['frame'])], {'x': guv['x'], 'y': guv['y'], 'r': np.ceil(guv['r']).astype(int)}))
         
         self.guv_data['intensity'] = intensities
 
-        # set channel back
-        self.stack.default_coords['c'] = self.params.channel
+    def find_GUV_at(self, x, y, frame, roi_radius=None, num_frames=None):
+        """Detect, link and measure a GUV near a position, using only a region of interest around it (e.g. a GUV that was missed)
+
+        The same steps as `run_analysis` are carried out, but only on a square of `2*roi_radius` px
+        around (x,y) in the frames around `frame`, which takes a fraction of a second. Regions that
+        touch the border of the square are left out, as they may be cut off. If no GUV that contains
+        the position is found, the square is enlarged (up to the whole frame) to find larger GUVs.
+
+        Args:
+            x, y (float): position (px)
+            frame (int): frame of the position
+            roi_radius (int): half the size of the first region of interest (px), twice the radius of the
+                largest GUV found so far (at least 64 px and twice `track_xy_thresh`) if None
+            num_frames (int): number of frames before and after `frame` that are used (enough to
+                reach the minimum track length if None)
+
+        Returns:
+            pd.DataFrame: a single row with the data of the GUV (same columns as `get_data`), or an empty
+                DataFrame if no GUV that contains the position is found
+        """
+        if roi_radius is None:
+            largest = self.guv_data['r'].max() if not self.guv_data.empty else 0
+            roi_radius = int(np.ceil(max(64, 2*largest, 2*self.params.track_xy_thresh)))
+        if num_frames is None:
+            num_frames = max(self.params.track_min_length, 2*self.params.track_z_thresh)
+        if not hasattr(self, 'edge_thresholds'): # the thresholds of the whole stack, as used by `detect_regions`
+            self.edge_thresholds = helpers.edge_thresholds(self.frames, self.params)
+        low, high = self.edge_thresholds
+        params = replace(self.params, canny_low_threshold=low, canny_high_threshold=high, auto_threshold=None)
+        frames = {i: self.frames[i] for i in range(max(frame - num_frames, 0), min(frame + num_frames + 1, len(self.frames)))}
+        height, width = np.shape(frames[frame])
+        while True:
+            guv = self._find_GUV_in_roi(x, y, frames, roi_radius, params)
+            if not guv.empty or roi_radius >= max(height, width): # found, or the whole frame was used
+                return guv
+            roi_radius *= 2
+
+    def _find_GUV_in_roi(self, x, y, frames, roi_radius, params):
+        """See `find_GUV_at`, `frames` are the frames to use (by index) and `params` has the edge thresholds of the stack"""
+        height, width = np.shape(next(iter(frames.values())))
+        x0, x1 = max(int(x) - roi_radius, 0), min(int(x) + roi_radius, width)
+        y0, y1 = max(int(y) - roi_radius, 0), min(int(y) + roi_radius, height)
+
+        regions = RegionStore()
+        for i, full_frame in frames.items():
+            _, labels = helpers.find_edges_and_labels(np.ascontiguousarray(full_frame[y0:y1, x0:x1]), params)
+            frame_regions_df = helpers.regions_from_labels(labels)
+            regions.append(frame=i, x=frame_regions_df['x'].to_numpy() + x0, y=frame_regions_df['y'].to_numpy() + y0,
+                           **{name: frame_regions_df[name].to_numpy() for name in ('r', 'area', 'ar')})
+        # only the borders of the square that are not the border of the frame can cut regions off
+        inside = (((regions['x'] - regions['r'] > x0) | (x0 == 0)) & ((regions['x'] + regions['r'] < x1 - 1) | (x1 == width)) &
+                  ((regions['y'] - regions['r'] > y0) | (y0 == 0)) & ((regions['y'] + regions['r'] < y1 - 1) | (y1 == height)))
+        regions = helpers.filter_GUV_dataframe(regions[inside], self.params)
+        self.link_GUV_points(regions)
+        tracks, regions['num_points'] = helpers.reduce_tracks(regions)
+
+        valid_tracks = (tracks['num_points'] >= self.params.track_min_length) & (tracks['guv_id'] != -1)
+        best = tracks['best_index'][valid_tracks]
+        distances = np.hypot(regions['x'][best] - x, regions['y'][best] - y)
+        contains = distances <= regions['r'][best]
+        if not np.any(contains):
+            return pd.DataFrame(columns=self.guv_data.columns)
+        track = np.flatnonzero(valid_tracks)[contains][np.argmin(distances[contains])] # the closest track that contains the position
+
+        guv = regions[[tracks['best_index'][track]]].to_dataframe()
+        for name in ('z_min', 'z_max', 'area_mean', 'r_std'):
+            guv[name] = tracks[name][track]
+        guv['guv_id'] = self.guv_data['guv_id'].max() + 1 if 'guv_id' in self.guv_data and not self.guv_data.empty else 0
+        guv['r_um'] = guv['r']*self.metadata['pixel_microns']
+        intensity_frame = helpers.as_8bit(self.stack.with_channel(self.params.intensity_channel))[int(guv['frame'].iloc[0])]
+        guv['intensity'] = [helpers.scaled_GUV_intensity(intensity_frame, {'x': guv['x'].iloc[0], 'y': guv['y'].iloc[0], 'r': np.ceil(guv['r'].iloc[0]).astype(int)})]
+        return guv
 
     def make_plots(self):
         with sns.axes_style('white'):
             self.figure.clear()
             self.axs = self.figure.subplots(3,1)
-            self.guv_data['r_um'] = self.guv_data['r']*self.metadata['pixel_microns']
 
-            self.axs[0].scatter(self.guv_data['x'], self.guv_data['y'])
+            self.position_points = self.axs[0].scatter(self.guv_data['x'], self.guv_data['y'])
             self.axs[0].set_title("GUV positions in (x,y) plane")
             self.axs[0].set_aspect(1)
             self.axs[0].set_xlim(0,self.stack.sizes['x'])
             self.axs[0].set_ylim(self.stack.sizes['y'], 0) # images have their origin at top left
 
-            self.axs[1].hist(self.guv_data['r_um'])
-            self.axs[1].set_xlabel(r"radius (µm)")
-            self.axs[1].set_title("Distribution of radii")
+            self.plot_radius_histogram()
 
-            self.axs[2].scatter(self.guv_data['r_um'], self.guv_data['intensity'])
+            self.intensity_points = self.axs[2].scatter(self.guv_data['r_um'], self.guv_data['intensity'])
             self.axs[2].set_xlabel(r"radius (µm)")
             self.axs[2].set_ylabel(r"$I/I^{max}_{sphere}$")
             self.axs[2].set_title("Radius versus intensity")
@@ -250,9 +586,29 @@ class GUV_finder:
 
         self.canvas.draw()
 
-    def renew(self, guv_data):
+    def plot_radius_histogram(self):
+        self.axs[1].clear()
+        self.axs[1].hist(self.guv_data['r_um'])
+        self.axs[1].set_xlabel(r"radius (µm)")
+        self.axs[1].set_title("Distribution of radii")
+
+    def update_plots(self):
+        """Update the plots of `make_plots` with the current data, without building the figure again (e.g. after the user removed or added a GUV)"""
+        self.position_points.set_offsets(np.column_stack([self.guv_data['x'], self.guv_data['y']]))
+        self.intensity_points.set_offsets(np.column_stack([self.guv_data['r_um'], self.guv_data['intensity']]))
+        self.axs[2].update_datalim(self.intensity_points.get_offsets())
+        self.axs[2].autoscale_view()
+        self.plot_radius_histogram()
+        self.canvas.draw_idle()
+
+    def renew(self, guv_data, incremental=False):
+        """Replace the data, the plots are only updated if `incremental` (the data of the same analysis has been changed by the user)"""
         self.guv_data = guv_data
-        self.make_plots()
+        if self.figure is not None:
+            if incremental and hasattr(self, 'position_points'):
+                self.update_plots()
+            else:
+                self.make_plots()
     
     def get_data(self):
         return self.guv_data
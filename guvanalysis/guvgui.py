@@ -12,7 +12,7 @@ from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 import matplotlib.patches
 from matplotlib.backend_bases import MouseEvent,MouseButton
 from scipy.spatial import KDTree
-from pims.image_sequence import ImageSequenceND
+from .framesource import ZStack
 import pandas as pd
 from pandas import DataFrame
 import pickle
@@ -21,14 +21,15 @@ import os
 class GUV_GUI:
     """Graphical User Interface for selecting GUVs from the microscopy data"""
 
-    def __init__(self, stack: ImageSequenceND, guv_data: DataFrame, canvas: FigureCanvasTkAgg, figure: Figure, updateddata_callback = None):
+    def __init__(self, stack: ZStack, guv_data: DataFrame, canvas: FigureCanvasTkAgg, figure: Figure, updateddata_callback = None, guvfinder = None):
         """Initialize the GUI
         
         Keyword Arguments:
-            stack {ImageSequenceND}: The stack to analyse
+            stack {ZStack}: The stack to analyse
             guv_data {pd.DataFrame}: DataFrame containing the positions (x,y) and radii (r) of the GUVs
             canvas {FigureCanvasTkAgg}: The canvas used to plot
             figure {Figure}: The figure object used to plot
+            guvfinder {GUV_finder}: Used to find a GUV where the user clicks (left click), None to only allow removing GUVs
         """
         self.stack = stack
         # self.stack.bundle_axes = "yx"
@@ -39,6 +40,7 @@ class GUV_GUI:
         self.fig = figure
 
         self.updateddata_callback = updateddata_callback # function to call if data is updated by user
+        self.guvfinder = guvfinder
         
         self.current_frame = 0
 
@@ -122,14 +124,30 @@ class GUV_GUI:
     def _onclick_guvselector(self, event):
         """Handler for clicking the plot
 
-        Adds artists to the current frame and removes them on right click
+        Adds a GUV at the clicked point on left click (if it can be found) and removes the closest one on right click
         
         Args:
             event (matplotlib.backend_bases.MouseEvent): Click event
         """
+        if event.xdata is None: # outside of the image
+            return
         coord = np.array([event.xdata, event.ydata]) # x,y coordinate of the clicked point
-        
-        if event.button == MouseButton.RIGHT: # remove closest point
+
+        if event.button == MouseButton.LEFT and self.guvfinder is not None: # find a GUV around the point and add it
+            guv = self.guvfinder.find_GUV_at(coord[0], coord[1], self.current_frame)
+            if guv.empty:
+                self.ax.set_title(f'frame {self.current_frame}/{len(self.stack)-1} (no GUV found at the clicked point)')
+            elif self._is_known_GUV(guv.iloc[0]):
+                self.ax.set_title(f'frame {self.current_frame}/{len(self.stack)-1} (this GUV was found already)')
+            else:
+                guv.index = [self.guv_data.index.max() + 1 if not self.guv_data.empty else 0] # the removal uses the index
+                self.guv_data = pd.concat([self.guv_data, guv]) if not self.guv_data.empty else guv
+                self.make_current_frame_points_array()
+                self.ax.set_title(f'frame {self.current_frame}/{len(self.stack)-1}  ({len(self.guv_points)} GUVs)')
+                if self.updateddata_callback is not None:
+                    self.updateddata_callback()
+
+        elif event.button == MouseButton.RIGHT: # remove closest point
             idx_to_remove = self.find_closest_point_in_current_frame(np.array(coord))
             if idx_to_remove >= 0:                     
                 self.guv_data = self.guv_data.drop(idx_to_remove)
@@ -139,6 +157,14 @@ class GUV_GUI:
         
         self.draw_points_on_frame()
 
+    def _is_known_GUV(self, guv):
+        """Whether a GUV has been found already: another GUV has its centre within the linking distance and frame range of it"""
+        if self.guv_data.empty:
+            return False
+        params = self.guvfinder.params
+        close = np.hypot(self.guv_data['x'] - guv['x'], self.guv_data['y'] - guv['y']) <= params.track_xy_thresh
+        return bool(np.any(close & (np.abs(self.guv_data['frame'] - guv['frame']) <= max(params.track_z_thresh, guv['z_max'] - guv['z_min']))))
+
     def _onscroll_guvselector(self, event):
         """Handler for scrolling
 
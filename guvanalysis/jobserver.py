@@ -0,0 +1,279 @@
+import os
+import json
+import time
+import getpass
+import signal
+import threading
+import itertools
+import urllib.parse
+import urllib.request
+import urllib.error
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import asdict, replace
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from .parameters import ParameterList
+from .framesource import open_frame_source
+from .manifest import RunManifest, analysis_key, content_hash
+from .output import ResultWriter, store_results, find_results
+from .batch import find_series_GUVs
+
+DEFAULT_PORT = 8421
+"""Port of the job server, it only listens on localhost"""
+
+
+class JobServer:
+    """Long-running server that analyses series for all users of a workstation with a fixed number of cores
+
+    Jobs (a file, series and parameters) are submitted over a small HTTP API on localhost (see
+    `submit_jobs`, `list_jobs` and `cancel_job` for the client side). They are analysed by a pool
+    of worker processes that stays alive, so the imports, compiled kernels and buffers of the
+    workers are reused by every job. A job uses `detection_workers` cores (at least one), and jobs
+    are only started while the total number of cores in use stays within `cores`. The next job is
+    taken from the user that currently uses the fewest cores (the oldest job first), such that a
+    large submission of one user does not block the jobs of the others.
+
+    API (json):
+        GET /status: number of cores in use and number of jobs per status
+        GET /jobs, GET /jobs/<id>: the jobs with their status and timings (`?owner=name` to filter)
+        POST /jobs: `{"parameters": {...}, "series": [0, 1] or null for all, "owner": "name"}`, returns the job ids
+        DELETE /jobs/<id>: cancel a queued job (running jobs are finished)
+    """
+
+    def __init__(self, cores: int = None, port: int = DEFAULT_PORT):
+        self.cores = cores or os.cpu_count()
+        self.port = port
+        self.jobs = {} # by id, in order of submission
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event() # set when jobs are submitted
+        self._started = time.time()
+
+    def submit(self, params: ParameterList, series=None, owner=None):
+        """Add a job for every series (all series of the file if None) to the queue
+
+        Series that have been analysed before with the same parameters are finished at once.
+
+        Returns:
+            list of int: the ids of the jobs
+        """
+        if series is None:
+            with open_frame_source(params.filename) as source:
+                series = list(range(source.sizes['v'])) if 'v' in source.sizes else [None]
+        contents = content_hash(params.filename)
+        ids = []
+        for i in series:
+            job_params = replace(params, series=i)
+            resultsfilename = find_results(job_params, analysis_key(job_params, contents))
+            with self._lock:
+                job = {'id': next(self._ids), 'owner': owner or "unknown", 'filename': params.filename, 'series': i,
+                       'status': 'finished' if resultsfilename else 'queued', 'cores': min(max(params.detection_workers, 1), self.cores),
+                       'submitted': time.time(), 'started': None, 'finished': None,
+                       'results': resultsfilename, 'num_guvs': None, 'error': None, 'params': job_params}
+                if resultsfilename:
+                    job['finished'] = job['submitted']
+                self.jobs[job['id']] = job
+            ids.append(job['id'])
+        self._wakeup.set()
+        return ids
+
+    def cancel(self, job_id):
+        """Cancel a queued job, returns whether it has been cancelled"""
+        with self._lock:
+            job = self.jobs[job_id]
+            if job['status'] != 'queued':
+                return False
+            job['status'] = 'cancelled'
+            job['finished'] = time.time()
+            return True
+
+    def cores_in_use(self):
+        return sum(job['cores'] for job in self.jobs.values() if job['status'] == 'running')
+
+    def _next_job(self):
+        """The oldest queued job of the user that uses the fewest cores, or None if it does not fit in the free cores"""
+        queued = [job for job in self.jobs.values() if job['status'] == 'queued']
+        if not queued:
+            return None
+        used = {}
+        for job in self.jobs.values():
+            if job['status'] == 'running':
+                used[job['owner']] = used.get(job['owner'], 0) + job['cores']
+        job = min(queued, key=lambda job: (used.get(job['owner'], 0), job['id']))
+        # waiting for cores instead of starting smaller jobs first, such that jobs with many cores are not starved
+        return job if self.cores_in_use() + job['cores'] <= self.cores else None
+
+    def _start_jobs(self, executor, running):
+        with self._lock:
+            while True:
+                job = self._next_job()
+                if job is None:
+                    return
+                job['status'] = 'running'
+                job['started'] = time.time()
+                manifest = RunManifest(job['filename'], content_hash(job['filename'])) # only hashed again when the file has changed
+                running[executor.submit(find_series_GUVs, job['params'], manifest)] = job
+
+    def _finish_job(self, job, future, writer):
+        try:
+            params, guv_data = future.result()
+            resultsfilename, _ = store_results(params, guv_data, RunManifest(params.filename), writer)
+            with self._lock:
+                job.update(status='finished', finished=time.time(), results=resultsfilename, num_guvs=len(guv_data))
+        except Exception as e:
+            with self._lock:
+                job.update(status='failed', finished=time.time(), error=str(e))
+        print(f"Job {job['id']} ({job['owner']}, series {job['series']} of {job['filename']}) {job['status']} "
+              f"in {job['finished'] - job['started']:.1f} s{': ' + job['error'] if job['error'] else ''}")
+
+    def status(self):
+        with self._lock:
+            counts = {}
+            for job in self.jobs.values():
+                counts[job['status']] = counts.get(job['status'], 0) + 1
+            return {'cores': self.cores, 'cores_in_use': self.cores_in_use(), 'jobs': counts,
+                    'uptime_s': round(time.time() - self._started, 1)}
+
+    def describe(self, job):
+        """The job as json, with its timings"""
+        now = time.time()
+        result = {key: value for key, value in job.items() if key != 'params'}
+        for key in ('submitted', 'started', 'finished'):
+            if job[key] is not None:
+                result[key] = datetime.fromtimestamp(job[key]).isoformat(timespec='seconds')
+        result['wait_s'] = round((job['started'] or job['finished'] or now) - job['submitted'], 1)
+        result['run_s'] = round((job['finished'] or now) - job['started'], 1) if job['started'] else None
+        return result
+
+    def describe_jobs(self, owner=None):
+        with self._lock:
+            return [self.describe(job) for job in self.jobs.values() if owner is None or job['owner'] == owner]
+
+    def run(self):
+        """Serve requests and run the jobs until interrupted (Ctrl+C), running jobs are finished before it stops"""
+        httpd = ThreadingHTTPServer(("127.0.0.1", self.port), _RequestHandler)
+        httpd.jobserver = self
+        threading.Thread(target=httpd.serve_forever, name="JobServer", daemon=True).start()
+        writer = ResultWriter()
+        running = {}
+        print(f"Job server with {self.cores} cores listening on http://127.0.0.1:{self.port}")
+        try:
+            with ProcessPoolExecutor(max_workers=self.cores, initializer=_warm_up) as executor:
+                while True:
+                    self._start_jobs(executor, running)
+                    if not running:
+                        self._wakeup.wait(1.)
+                        self._wakeup.clear()
+                        continue
+                    done, _ = wait(list(running), timeout=1., return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self._finish_job(running.pop(future), future, writer)
+        except KeyboardInterrupt:
+            print("Stopping, queued jobs are not analysed")
+            for future, job in running.items(): # the pool has waited for the running jobs
+                self._finish_job(job, future, writer)
+        finally:
+            httpd.shutdown()
+            writer.close()
+
+
+def _warm_up():
+    # imports and compiles everything once per worker, Ctrl+C is handled by the server
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    import numpy as np
+    from . import fastdetect
+    if fastdetect.available():
+        fastdetect.find_edges_and_labels(np.zeros((16, 16), dtype=np.uint8), 1.)
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+
+    def _reply(self, data, code=200):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _job_id(self):
+        try:
+            job_id = int(self.path.split("?")[0].split("/")[2])
+        except (IndexError, ValueError):
+            return None
+        return job_id if job_id in self.server.jobserver.jobs else None
+
+    def do_GET(self):
+        server = self.server.jobserver
+        path, _, query = self.path.partition("?")
+        if path == "/status":
+            self._reply(server.status())
+        elif path == "/jobs":
+            self._reply(server.describe_jobs(urllib.parse.parse_qs(query).get('owner', [None])[0]))
+        elif path.startswith("/jobs/") and self._job_id() is not None:
+            with server._lock:
+                self._reply(server.describe(server.jobs[self._job_id()]))
+        else:
+            self._reply({'error': f"Unknown job or path {path}"}, 404)
+
+    def do_POST(self):
+        if self.path != "/jobs":
+            self._reply({'error': f"Unknown path {self.path}"}, 404)
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            params = ParameterList(**request['parameters'])
+            ids = self.server.jobserver.submit(params, request.get('series'), request.get('owner'))
+        except Exception as e:
+            self._reply({'error': f"Invalid job: {e}"}, 400)
+            return
+        self._reply({'jobs': ids})
+
+    def do_DELETE(self):
+        job_id = self._job_id()
+        if not self.path.startswith("/jobs/") or job_id is None:
+            self._reply({'error': f"Unknown job or path {self.path}"}, 404)
+            return
+        self._reply({'cancelled': self.server.jobserver.cancel(job_id)})
+
+    def log_message(self, format, *args):
+        pass # every request would be printed otherwise
+
+
+def _request(method, path, data=None, port=DEFAULT_PORT):
+    request = urllib.request.Request(f"http://127.0.0.1:{port}{path}", method=method,
+                                     data=json.dumps(data).encode() if data is not None else None,
+                                     headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return json.load(response)
+    except urllib.error.HTTPError as e:
+        raise ValueError(json.load(e).get('error', str(e))) from None
+    except urllib.error.URLError as e:
+        raise ConnectionError(f"No job server running on port {port}, start one with `python -m guvanalysis serve` ({e.reason})") from None
+
+
+def submit_jobs(params: ParameterList, series=None, owner=None, port=DEFAULT_PORT):
+    """Submit the analysis of the series of a file to the job server (all series if None)
+
+    Returns:
+        list of int: the ids of the jobs
+    """
+    params = replace(params, filename=os.path.abspath(params.filename)) # the server may run in another directory
+    return _request("POST", "/jobs", {'parameters': asdict(params), 'series': series, 'owner': owner or getpass.getuser()}, port)['jobs']
+
+
+def list_jobs(job_id=None, owner=None, port=DEFAULT_PORT):
+    """Get all jobs (or a single one) of the job server with their status and timings"""
+    if job_id is not None:
+        return [_request("GET", f"/jobs/{job_id}", port=port)]
+    return _request("GET", "/jobs" + ("?" + urllib.parse.urlencode({'owner': owner}) if owner else ""), port=port)
+
+
+def cancel_job(job_id, port=DEFAULT_PORT):
+    """Cancel a queued job, returns whether it has been cancelled"""
+    return _request("DELETE", f"/jobs/{job_id}", port=port)['cancelled']
+
+
+def server_status(port=DEFAULT_PORT):
+    return _request("GET", "/status", port=port)
@@ -0,0 +1,232 @@
+import os
+import glob
+import json
+import hashlib
+from dataclasses import asdict, fields
+import numpy as np
+import pandas as pd
+from .parameters import ParameterList
+
+DETECTION_PARAMETERS = ('channel', 'series', 'time_point', 'blur_radius', 'tile_size', 'tile_overlap',
+                        'canny_low_threshold', 'canny_high_threshold', 'auto_threshold', 'auto_threshold_percentile', 'auto_threshold_ratio')
+
+STAGE_PARAMETERS = {
+    'regions': DETECTION_PARAMETERS,
+    'tracks': DETECTION_PARAMETERS + ('guv_min_radius', 'guv_max_aspect_ratio', 'track_xy_thresh', 'track_z_thresh'),
+}
+"""Parameters that affect the output of every stage, the final data depends on all parameters"""
+
+EXECUTION_PARAMETERS = ('compiled_detection', 'detection_workers')
+"""Parameters that only change how the analysis is run and not its result"""
+
+
+SAMPLE_SIZE = 2**16
+"""Size of the blocks of a file that are hashed by `content_hash`"""
+NUM_SAMPLES = 64
+"""Number of blocks, spread evenly over a file, that are hashed by `content_hash`"""
+
+_content_hashes = {} # by the names, sizes and modification times of the files, see `content_hash`
+
+
+def content_hash(filename):
+    """Hash of the contents of an input file (or of all files matching a pattern such as `dir/*.tif`)
+
+    Uses the size and a sample of evenly spread blocks of every file (files up to `NUM_SAMPLES`
+    blocks are hashed completely), but not the name or modification time, so a copy of a file
+    has the same hash. The hash is computed once per process for the same (unchanged) files.
+    """
+    files = sorted(glob.glob(filename))
+    stats = [os.stat(f) for f in files]
+    signature = tuple((os.path.abspath(f), stat.st_size, stat.st_mtime_ns) for f, stat in zip(files, stats))
+    if signature in _content_hashes:
+        return _content_hashes[signature]
+    sha = hashlib.sha1()
+    for f, stat in zip(files, stats):
+        size = stat.st_size
+        sha.update(f"{size}:".encode())
+        with open(f, "rb") as fh:
+            if size <= NUM_SAMPLES*SAMPLE_SIZE:
+                sha.update(fh.read())
+                continue
+            for offset in np.linspace(0, size - SAMPLE_SIZE, NUM_SAMPLES).astype(np.int64):
+                fh.seek(int(offset))
+                sha.update(fh.read(SAMPLE_SIZE))
+    _content_hashes[signature] = sha.hexdigest()
+    return _content_hashes[signature]
+
+
+def file_fingerprint(filename, contents=None):
+    """Fingerprint of an input file that changes whenever the file is changed or touched (used to check whether checkpoints are stale)
+
+    Args:
+        filename (str): file, or pattern of files
+        contents (str): `content_hash` of the file (computed if None)
+    """
+    sha = hashlib.sha1((contents or content_hash(filename)).encode())
+    for f in sorted(glob.glob(filename)):
+        stat = os.stat(f)
+        sha.update(f"{os.path.basename(f)}:{stat.st_mtime_ns}".encode())
+    return sha.hexdigest()
+
+
+def _typed_values(params: ParameterList):
+    """The parameters as dict, with the numbers converted to the type of their field (e.g. 3 to 3. for a float and 3. to 3 for an int)
+
+    The GUI and json files do not always give numbers of the right type, these should not change the keys
+    """
+    values = asdict(params)
+    for field in fields(params):
+        value = values[field.name]
+        if field.type is float and isinstance(value, int) and not isinstance(value, bool):
+            values[field.name] = float(value)
+        elif field.type is int and isinstance(value, float) and value.is_integer():
+            values[field.name] = int(value)
+    return values
+
+
+def parameters_key(params: ParameterList, stage=None):
+    """Hash of the parameters that affect the output of the given stage (all parameters if None)"""
+    values = _typed_values(params)
+    del values['filename'] # the file is checked by its fingerprint, such that it can be moved
+    for name in EXECUTION_PARAMETERS:
+        del values[name]
+    if stage is not None:
+        values = {name: values[name] for name in STAGE_PARAMETERS[stage]}
+    return hashlib.sha1(json.dumps(values, sort_keys=True).encode()).hexdigest()
+
+
+def analysis_key(params: ParameterList, contents=None, selection: pd.DataFrame = None):
+    """Key of an analysis, which is the same for the same file contents (series, channel) and parameters
+
+    Copies of a file (also with another name or modification time) give the same key
+
+    Args:
+        params (ParameterList): parameters of the analysis
+        contents (str): `content_hash` of the file (computed if None)
+        selection (pd.DataFrame): GUVs that were kept by the user, if the data is not the plain result of the parameters
+
+    Returns:
+        str: hex digest
+    """
+    sha = hashlib.sha1()
+    sha.update((contents or content_hash(params.filename)).encode())
+    sha.update(parameters_key(params).encode())
+    if selection is not None:
+        sha.update(selection[['frame', 'x', 'y', 'r']].to_csv(index=False).encode())
+    return sha.hexdigest()
+
+
+class RunManifest:
+    """Keeps track of the progress of the analysis of all series of a file
+
+    For every series a small json record is kept in the checkpoint directory next to the file,
+    with the status of the series and the outputs of the finished stages (raw regions, linked
+    tracks and final data). An interrupted run can thereby skip finished series and stages.
+    Stage outputs are only reused if the input file, the relevant parameters and the stored
+    output file itself are unchanged. Every series has its own record, such that series can
+    be analysed by separate processes.
+    """
+
+    def __init__(self, filename, contents=None):
+        """
+        Args:
+            filename (str): the input file (or pattern of files)
+            contents (str): `content_hash` of the file, if it is already known (e.g. the manifest is sent to a worker process)
+        """
+        self.filename = filename
+        self.directory = filename.replace(".nd2","").replace("*.tif","") + "_GUVcheckpoints"
+        self._content_hash = contents
+        self._fingerprint = None
+
+    @property
+    def content_hash(self):
+        """`content_hash` of the file, used for the keys of the analyses"""
+        if self._content_hash is None:
+            self._content_hash = content_hash(self.filename)
+        return self._content_hash
+
+    @property
+    def fingerprint(self):
+        """`file_fingerprint` of the file, used to check whether the records and stages are stale"""
+        if self._fingerprint is None:
+            self._fingerprint = file_fingerprint(self.filename, self.content_hash)
+        return self._fingerprint
+
+    def _record_filename(self, params: ParameterList, extension=".json", stage=None):
+        name = 's%02d' % params.series if params.series is not None else 'series'
+        if params.time_point:
+            name += '-t%03d' % params.time_point
+        if stage is not None:
+            name += f"-{stage}"
+        return os.path.join(self.directory, name + extension)
+
+    def load_record(self, params: ParameterList):
+        """Return the record of the series in `params` (empty if it does not exist or belongs to a changed file)"""
+        recordfilename = self._record_filename(params)
+        if os.path.exists(recordfilename):
+            with open(recordfilename, "r") as recordfile:
+                record = json.load(recordfile)
+            if record.get('fingerprint') == self.fingerprint:
+                return record
+        return {'fingerprint': self.fingerprint, 'status': 'new', 'stages': {}}
+
+    def _write_record(self, params: ParameterList, record):
+        os.makedirs(self.directory, exist_ok=True)
+        recordfilename = self._record_filename(params)
+        with open(recordfilename + ".tmp", "w") as recordfile:
+            json.dump(record, recordfile, indent=4)
+        os.replace(recordfilename + ".tmp", recordfilename) # replace at once, such that a crash never leaves a broken record
+
+    def mark_running(self, params: ParameterList):
+        record = self.load_record(params)
+        record['status'] = 'running'
+        self._write_record(params, record)
+
+    def save_stage(self, params: ParameterList, stage, data: pd.DataFrame):
+        """Store the output of a stage of the analysis of a series"""
+        os.makedirs(self.directory, exist_ok=True)
+        datafilename = self._record_filename(params, ".csv", stage)
+        data.to_csv(datafilename, index=False, header=True)
+        record = self.load_record(params)
+        record['stages'][stage] = {
+            'filename': datafilename,
+            'parameters': parameters_key(params, stage),
+            'mtime_ns': os.stat(datafilename).st_mtime_ns,
+        }
+        self._write_record(params, record)
+
+    def load_stage(self, params: ParameterList, stage):
+        """Return the stored output of a stage, or None if it has to be (re)computed"""
+        entry = self.load_record(params)['stages'].get(stage)
+        if entry is None or entry['parameters'] != parameters_key(params, stage):
+            return None
+        if not os.path.exists(entry['filename']) or os.stat(entry['filename']).st_mtime_ns != entry['mtime_ns']:
+            return None
+        print(f"Reusing {stage} of {os.path.basename(self._record_filename(params, ''))} from {entry['filename']}")
+        return pd.read_csv(entry['filename'], header=0)
+
+    def mark_finished(self, params: ParameterList, resultsfilename, paramsfilename):
+        """Record that the final data of a series has been stored"""
+        record = self.load_record(params)
+        record['status'] = 'finished'
+        record['results'] = {
+            'data': resultsfilename,
+            'parameters_file': paramsfilename,
+            'parameters': parameters_key(params),
+        }
+        self._write_record(params, record)
+
+    def finished_results(self, params: ParameterList, check_parameters=True):
+        """Return the results filename if the series has been finished before, otherwise None
+
+        Args:
+            params (ParameterList): parameters of the series
+            check_parameters (bool): if False, a series that was finished with other parameters
+                (e.g. tuned by hand in the GUI) also counts as finished
+        """
+        record = self.load_record(params)
+        if record['status'] != 'finished' or not os.path.exists(record['results']['data']):
+            return None
+        if check_parameters and record['results']['parameters'] != parameters_key(params):
+            return None
+        return record['results']['data']
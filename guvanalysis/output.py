@@ -0,0 +1,228 @@
+import os
+import json
+import queue
+import atexit
+import threading
+from dataclasses import asdict
+from datetime import datetime
+import pandas as pd
+from .parameters import ParameterList
+from .resultindex import ResultIndex
+from .manifest import analysis_key
+
+
+def output_filename(params: ParameterList, kind="GUVdata", extension=".csv", date_suffix=None):
+    """Name of an output file of an analysis, which is stored next to the analysed file
+
+    Args:
+        params (ParameterList): parameters of the analysis (filename and series are used)
+        kind (str): type of output, e.g. GUVdata, GUVparams or GUVtimelapse
+        extension (str): file extension
+        date_suffix (str): suffix that is appended to the name (current date and time if None)
+
+    Returns:
+        str: the filename
+    """
+    filepath_without_ext = params.filename.replace(".nd2","").replace("*.tif","")
+    if date_suffix is None:
+        date_suffix = datetime.now().strftime("%y%m%d%H%M")
+    return f"{filepath_without_ext}_{'s%02d-' % params.series if params.series is not None else ''}{kind}_{date_suffix}{extension}"
+
+
+def output_filenames(params: ParameterList, key=None):
+    """Names of the data (.csv) and parameters (.json) file of an analysis
+
+    Args:
+        params (ParameterList): parameters of the analysis
+        key (str): key of the analysis (see `manifest.analysis_key`), which is used instead of the date,
+            such that the same analysis always gets the same name
+    """
+    suffix = key[:KEY_LENGTH] if key else datetime.now().strftime("%y%m%d%H%M")
+    return (output_filename(params, "GUVdata", ".csv", suffix),
+            output_filename(params, "GUVparams", ".json", suffix))
+
+
+KEY_LENGTH = 16
+"""Number of characters of the analysis key that are used in the filenames"""
+
+
+def find_results(params: ParameterList, key=None, index: ResultIndex = None):
+    """Find the stored results of an earlier analysis with the same file contents and parameters
+
+    Looks for the output files of the analysis next to the file first, then in the results index
+    (which also finds the results of a copy of the file)
+
+    Args:
+        params (ParameterList): parameters of the analysis
+        key (str): key of the analysis (computed from `params` if None)
+        index (ResultIndex): results index (the default index if None)
+
+    Returns:
+        str: name of the data file, or None if the analysis has not been stored before
+    """
+    key = key or analysis_key(params)
+    resultsfilename, paramsfilename = output_filenames(params, key)
+    if os.path.exists(resultsfilename) and os.path.exists(paramsfilename):
+        return resultsfilename
+    return (index or ResultIndex()).find(key)
+
+
+class ResultWriter:
+    """Writes output files in a background thread, such that the analysis (or GUI) does not wait for slow disks
+
+    Every file is first written to a temporary file next to it, which replaces the final file
+    at once, so a file is either complete or absent. Files that are submitted shortly after each
+    other are handled in batches: all temporary files of a batch are written before they are
+    renamed and before the callbacks (e.g. updating the run manifest) are called.
+    Use `flush` to wait until everything has been written; the shared writer of `result_writer`
+    is flushed automatically when python exits.
+    """
+
+    def __init__(self, batch_size=64):
+        self.batch_size = batch_size
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._errors = []
+
+    def submit(self, filename, write, callback=None):
+        """Write a file in the background
+
+        Args:
+            filename (str): name of the final file
+            write (callable): function that writes the data to the (temporary) filename it gets
+            callback (callable): called without arguments after the file has been written
+        """
+        with self._lock:
+            if self._thread is None:
+                # daemon thread, such that it cannot keep python alive, `close` is called at exit instead
+                self._thread = threading.Thread(target=self._run, name="ResultWriter", daemon=True)
+                self._thread.start()
+        self._queue.put((filename, write, callback))
+
+    def write_csv(self, filename, data: pd.DataFrame, callback=None):
+        data = data.copy() # the data may be changed while it is waiting to be written
+        self.submit(filename, lambda tmpfilename: data.to_csv(tmpfilename, index=False, header=True), callback)
+
+    def write_json(self, filename, data: dict, callback=None):
+        self.submit(filename, lambda tmpfilename: _dump_json(data, tmpfilename), callback)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            jobs = [job for job in batch if job is not None]
+            written = []
+            for filename, write, callback in jobs:
+                try:
+                    write(filename + ".tmp")
+                    written.append((filename, callback))
+                except Exception as e:
+                    self._fail(filename, e)
+                    if os.path.exists(filename + ".tmp"):
+                        os.remove(filename + ".tmp")
+            for filename, callback in written:
+                try:
+                    os.replace(filename + ".tmp", filename)
+                    if callback is not None:
+                        callback()
+                except Exception as e:
+                    self._fail(filename, e)
+            for _ in batch:
+                self._queue.task_done()
+            if batch[-1] is None: # stop signal of `close`
+                if self._queue.empty():
+                    return
+                self._queue.put(None) # first write the files that were submitted by the callbacks of this batch
+
+    def _fail(self, filename, error):
+        print(f"Could not write {filename}: {error}")
+        self._errors.append(error)
+
+    def flush(self):
+        """Wait until all submitted files have been written, raises the first error that occurred"""
+        self._queue.join()
+        if self._errors:
+            error, self._errors = self._errors[0], []
+            raise error
+
+    def close(self):
+        """Write all submitted files and stop the background thread"""
+        with self._lock:
+            thread = self._thread
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+            with self._lock: # only cleared now, such that files that are submitted by callbacks go to the same thread
+                if self._thread is thread:
+                    self._thread = None
+        self.flush()
+
+
+def _dump_json(data, filename):
+    with open(filename, "w") as jsonfile:
+        json.dump(data, jsonfile, indent=4)
+
+
+_writer = None
+
+def result_writer():
+    """The writer that is shared by all analyses of this process, it is flushed when python exits"""
+    global _writer
+    if _writer is None:
+        _writer = ResultWriter()
+        atexit.register(_close_at_exit, _writer)
+    return _writer
+
+
+def _close_at_exit(writer: ResultWriter):
+    try:
+        writer.close()
+    except Exception:
+        pass # the errors have been printed already
+
+
+def store_results(params: ParameterList, guv_data: pd.DataFrame, manifest=None, writer: ResultWriter = None,
+                  selection=False, index: ResultIndex = None, callback=None):
+    """Store the data and parameters of an analysis in the background
+
+    The files are named by the key of the analysis (see `manifest.analysis_key`), so storing the
+    same analysis again overwrites the same files. Once both files have been written, the series is marked as finished in the manifest (if
+    given) and the results are added to the results index
+
+    Args:
+        params (ParameterList): parameters of the analysis
+        guv_data (pd.DataFrame): data of the GUVs
+        manifest (RunManifest): run manifest of the file (None to skip)
+        writer (ResultWriter): writer to use (the shared `result_writer` if None)
+        selection (bool): whether `guv_data` is a selection made by the user (instead of the plain result
+            of the parameters), the selected GUVs are then part of the key of the analysis
+        index (ResultIndex): results index to add the data to (the default index if None)
+        callback (callable): called without arguments (in the thread of the writer) once both files have been written
+
+    Returns:
+        (str, str): the names of the data and parameters file
+    """
+    writer = writer or result_writer()
+    key = analysis_key(params, manifest.content_hash if manifest is not None else None, guv_data if selection else None)
+    resultsfilename, paramsfilename = output_filenames(params, key)
+    guv_data = guv_data.copy()
+
+    def finished():
+        if manifest is not None:
+            manifest.mark_finished(params, resultsfilename, paramsfilename)
+        try:
+            (index or ResultIndex()).add(params, guv_data, resultsfilename, key=key)
+        except Exception as e: # the data files are what matters, the index can be rebuilt from them
+            print(f"Could not add {resultsfilename} to the results index: {e}")
+        if callback is not None:
+            callback()
+
+    # the parameters file is only written once the data has been written, and the callbacks are not called
+    # when a write fails, so a series is never marked as finished without both files
+    writer.write_csv(resultsfilename, guv_data, lambda: writer.write_json(paramsfilename, asdict(params), finished))
+    return resultsfilename, paramsfilename
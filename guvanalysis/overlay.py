@@ -0,0 +1,157 @@
+import os
+import math
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from PIL import Image
+from .parameters import ParameterList
+from .guvfinder import helpers
+
+CURRENT_FRAME_COLOR = (255, 255, 0)
+"""Colour of the GUVs in the shown frame (or of all GUVs in a maximum projection), as in the GUI"""
+OTHER_FRAME_COLOR = (0, 0, 255)
+"""Colour of the GUVs of which the centre is in another frame"""
+
+
+def circle_pixels(x, y, r, shape, width=2.):
+    """Pixels on the outlines of a number of circles, computed for all circles at once
+
+    Args:
+        x, y, r (np.ndarray): centres and radii of the circles (px)
+        shape ((int, int)): shape of the image, pixels outside of it are left out
+        width (float): width of the outlines (px)
+
+    Returns:
+        (np.ndarray, np.ndarray, np.ndarray): the rows and columns of the pixels, and the index of the circle of every pixel
+    """
+    x, y, r = (np.asarray(a, dtype=float).ravel() for a in (x, y, r))
+    if len(r) == 0:
+        return np.empty(0, dtype=int), np.empty(0, dtype=int), np.empty(0, dtype=int)
+    # enough points along every circle that neighbouring points touch, also on the outer edge of the outline
+    counts = np.ceil(2*np.pi*(r + width) * 1.5).astype(int) + 8
+    circle = np.repeat(np.arange(len(r)), counts)
+    position = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    angle = 2*np.pi * position / counts[circle]
+    cos, sin = np.cos(angle), np.sin(angle)
+    rows, cols, circles = [], [], []
+    for offset in np.arange(-width/2, width/2, .5) + .25:
+        radius = np.maximum(r[circle] + offset, 0)
+        rows.append(np.rint(y[circle] + radius*sin).astype(int))
+        cols.append(np.rint(x[circle] + radius*cos).astype(int))
+        circles.append(circle)
+    rows, cols, circles = np.concatenate(rows), np.concatenate(cols), np.concatenate(circles)
+    inside = (rows >= 0) & (rows < shape[0]) & (cols >= 0) & (cols < shape[1])
+    return rows[inside], cols[inside], circles[inside]
+
+
+def to_rgb(frame):
+    """8-bit grey frame as RGB image (rows, columns, 3)"""
+    return np.repeat(np.asarray(frame, dtype=np.uint8)[..., np.newaxis], 3, axis=2)
+
+
+def draw_circles(image, x, y, r, color, alpha=1., width=2.):
+    """Draw the outlines of circles into an RGB image (in place)
+
+    Args:
+        image (np.ndarray): uint8 RGB image (rows, columns, 3)
+        x, y, r (np.ndarray): centres and radii of the circles (px)
+        color ((int, int, int)): RGB colour of the outlines
+        alpha (float): opacity of the outlines
+        width (float): width of the outlines (px)
+
+    Returns:
+        np.ndarray: the image
+    """
+    rows, cols, _ = circle_pixels(x, y, r, image.shape[:2], width)
+    blended = (1-alpha)*image[rows, cols] + alpha*np.asarray(color, dtype=float)
+    image[rows, cols] = np.rint(blended).astype(np.uint8) # pixels that are drawn twice get the same value
+    return image
+
+
+def render_frame(frame, guv_data: pd.DataFrame, current_frame=None, width=2.):
+    """Overlay of the GUVs on a frame
+
+    Args:
+        frame (np.ndarray): 8-bit frame, or a maximum projection
+        guv_data (pd.DataFrame): GUVs with the columns frame, x, y and r
+        current_frame (int): index of the frame in the stack, GUVs of other frames are drawn fainter
+            in another colour (like in the GUI), all GUVs are drawn the same if None (projection)
+        width (float): width of the outlines (px)
+
+    Returns:
+        np.ndarray: the uint8 RGB image
+    """
+    image = to_rgb(frame)
+    if current_frame is None:
+        return draw_circles(image, guv_data['x'], guv_data['y'], guv_data['r'], CURRENT_FRAME_COLOR, 1., width)
+    other = guv_data[guv_data['frame'] != current_frame]
+    current = guv_data[guv_data['frame'] == current_frame]
+    draw_circles(image, other['x'], other['y'], other['r'], OTHER_FRAME_COLOR, .5, width)
+    return draw_circles(image, current['x'], current['y'], current['r'], CURRENT_FRAME_COLOR, 1., width)
+
+
+def montage(images, columns=None, spacing=4):
+    """Tile images of the same shape into a single image (row by row, with black space in between)
+
+    Args:
+        images (list of np.ndarray): RGB images
+        columns (int): number of images next to each other (a square grid if None)
+        spacing (int): space between the images (px)
+    """
+    columns = columns or math.ceil(math.sqrt(len(images)))
+    rows = math.ceil(len(images) / columns)
+    height, width = images[0].shape[:2]
+    result = np.zeros((rows*height + (rows-1)*spacing, columns*width + (columns-1)*spacing, 3), dtype=np.uint8)
+    for i, image in enumerate(images):
+        top, left = (i // columns) * (height + spacing), (i % columns) * (width + spacing)
+        result[top:top+height, left:left+width] = image
+    return result
+
+
+def render_series(params: ParameterList, guv_data: pd.DataFrame, frames=False, columns=None, width=2.):
+    """Overlay of the GUVs found in a series on the maximum projection of its stack, or on every frame (as montage)
+
+    Returns:
+        np.ndarray: the uint8 RGB image
+    """
+    stack = helpers.as_8bit(helpers.open_stack(params, t=params.time_point))
+    if not frames:
+        return render_frame(np.max(np.stack(list(stack)), axis=0), guv_data, None, width)
+    return montage([render_frame(frame, guv_data, z, width) for z, frame in enumerate(stack)], columns)
+
+
+def overlay_filename(data_file, extension=".png"):
+    """Name of the overlay image of a data file, e.g. `plate_s01-GUVoverlay_<key>.png` next to `plate_s01-GUVdata_<key>.csv`
+
+    Tiff images get the extension `.tiff`, such that they are never mistaken for the frames of a directory of `*.tif` files
+    """
+    if extension in (".tif", ".tiff"):
+        extension = ".tiff"
+    return os.path.splitext(data_file.replace("GUVdata", "GUVoverlay"))[0] + extension
+
+
+def export_overlay(data_file, extension=".png", frames=False, columns=None, width=2.):
+    """Render the overlay of a data file (with the GUVparams file next to it) and store it next to it
+
+    Returns:
+        str: the name of the image file
+    """
+    params = ParameterList.from_json(data_file.replace("GUVdata", "GUVparams").replace(".csv", ".json"))
+    guv_data = pd.read_csv(data_file, header=0)
+    image = render_series(params, guv_data, frames, columns, width)
+    filename = overlay_filename(data_file, extension)
+    tmpfilename = filename + ".tmp"
+    Image.fromarray(image).save(tmpfilename, format="TIFF" if extension in (".tif", ".tiff") else "PNG")
+    os.replace(tmpfilename, filename) # the image is either complete or absent
+    return filename
+
+
+def export_overlays(data_files, extension=".png", frames=False, columns=None, width=2., max_workers=None):
+    """Render the overlays of a number of data files in parallel (see `export_overlay`), without any figures or display
+
+    Returns:
+        list of str: the names of the image files
+    """
+    with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        futures = [executor.submit(export_overlay, data_file, extension, frames, columns, width) for data_file in data_files]
+        return [future.result() for future in futures]
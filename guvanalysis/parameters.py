@@ -38,6 +38,42 @@ class ParameterList:
     track_min_length: int = 3
     """Minimal number of points that a track needs to have to be considered as a GUV stack"""
 
+    tile_size: int = None
+    """Size (in px) of the square tiles in which large images (e.g. stitched mosaics) are processed (None to process full frames)"""
+
+    tile_overlap: int = 150
+    """Overlap (in px) between neighbouring tiles, should be at least the maximal diameter of a GUV"""
+
+    time_point: int = 0
+    """Index of the time point that is analysed (only relevant for time-lapse files)"""
+
+    track_t_thresh: float = 10.
+    """Maximal displacement in xy plane (in px) of a GUV between two time points for it to be linked to the same GUV"""
+
+    track_t_memory: int = 2
+    """Number of time points a GUV may be missing before it is considered to be gone (time-lapse mode)"""
+
+    canny_low_threshold: float = 20.
+    """Low threshold of the hysteresis in the edge detection (gradient on the scale of the 8-bit frames)"""
+
+    canny_high_threshold: float = 50.
+    """High threshold of the hysteresis in the edge detection, edges need at least one point above it"""
+
+    auto_threshold: str = None
+    """Derive the edge detection thresholds from the gradients of each stack: 'percentile' or 'otsu' (None to use the fixed thresholds above)"""
+
+    auto_threshold_percentile: float = 98.
+    """Percentile of the gradient magnitude of the stack that is used as high threshold if auto_threshold is 'percentile' (should be above the fraction of pixels that are not on an edge)"""
+
+    auto_threshold_ratio: float = 0.4
+    """Ratio of the low to the high threshold if auto_threshold is set"""
+
+    compiled_detection: bool = False
+    """Use the compiled edge detection of fastdetect.py (requires numba), which gives the same result as the default skimage functions"""
+
+    detection_workers: int = 1
+    """Number of processes that detect the regions in the frames of a stack in parallel (the frames are shared with these processes through shared memory)"""
+
     def get_adjustable_variables(self):        
         vars = [
             ('blur_radius', "Blurring radius for the Gaussian blur that is used in the edge detection",(0., 10., 0.5)),
@@ -1,31 +1,164 @@
 from tkinter.filedialog import askopenfilenames
+import os
 import re
+import json
+import hashlib
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
+from matplotlib.colors import LogNorm
 import seaborn as sns
+from .resultindex import ResultIndex
 
+PLOT_VARIABLES = ["r_um", "intensity", "area"]
 
-def run():
+CACHE_DIRECTORY = os.path.join(os.path.expanduser("~"), ".guvanalysis", "plotcache")
+"""Directory in which the binned data of `cached_bins` is stored"""
+
+
+def plot(data: pd.DataFrame, hue="series"):
+    """Pairplot of the radius, intensity and area of the GUVs in `data`, coloured by `hue`"""
+    sns.set("paper","white")
+    sns.pairplot(data,vars=PLOT_VARIABLES,hue=hue)
+    plt.tight_layout()
+    plt.show()
+
+
+def subsample(data: pd.DataFrame, max_per_group, by="series", seed=0):
+    """Random selection of at most `max_per_group` GUVs of every group (e.g. series), such that small groups are kept completely"""
+    return data.groupby(by, group_keys=False, sort=False).apply(
+        lambda group: group.sample(n=min(len(group), max_per_group), random_state=seed))
+
+
+def compute_bins(data: pd.DataFrame, variables=PLOT_VARIABLES, bins=100):
+    """Histograms of every variable and 2D histograms of every pair of variables
+
+    The bins span the range of every variable (without NaN), so they can be plotted without the data
+
+    Returns:
+        dict: the bin edges (variables, bins+1), the 1D counts (variables, bins), the 2D counts
+            (variables, variables, bins, bins) and the number of GUVs
+    """
+    values = [data[variable].to_numpy(dtype=float) for variable in variables]
+    edges = np.empty((len(variables), bins+1))
+    for i, v in enumerate(values):
+        finite = v[np.isfinite(v)]
+        low, high = (finite.min(), finite.max()) if len(finite) else (0., 1.)
+        edges[i] = np.linspace(low, high if high > low else low + 1., bins+1)
+    counts = np.zeros((len(variables), bins), dtype=np.int64)
+    counts2d = np.zeros((len(variables), len(variables), bins, bins), dtype=np.int64)
+    for i in range(len(variables)):
+        counts[i] = np.histogram(values[i], edges[i])[0]
+        for j in range(i+1, len(variables)):
+            finite = np.isfinite(values[i]) & np.isfinite(values[j])
+            counts2d[i, j] = np.histogram2d(values[i][finite], values[j][finite], [edges[i], edges[j]])[0]
+            counts2d[j, i] = counts2d[i, j].T
+    return {'edges': edges, 'counts': counts, 'counts2d': counts2d, 'num_guvs': np.array(len(data))}
+
+
+def cached_bins(key, load_data, variables=PLOT_VARIABLES, bins=100):
+    """The result of `compute_bins` for the data of `load_data`, which is only called when the bins have not been cached before
+
+    Args:
+        key: json-serializable description of the data that changes whenever the data changes
+            (e.g. the names, sizes and modification times of the files)
+        load_data (callable): returns the data (pd.DataFrame)
+    """
+    sha = hashlib.sha1(json.dumps([key, list(variables), bins], sort_keys=True, default=str).encode()).hexdigest()
+    filename = os.path.join(CACHE_DIRECTORY, f"{sha}.npz")
+    if os.path.exists(filename):
+        with np.load(filename) as cached:
+            return dict(cached)
+    binned = compute_bins(load_data(), variables, bins)
+    os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+    np.savez(filename + ".tmp.npz", **binned)
+    os.replace(filename + ".tmp.npz", filename)
+    return binned
+
+
+def plot_binned(binned: dict, variables=PLOT_VARIABLES):
+    """Pairplot of binned data (see `compute_bins`): histograms on the diagonal and 2D histograms (log colour scale) elsewhere
+
+    Drawing takes the same time for any number of GUVs
+    """
     sns.set("paper","white")
+    edges = binned['edges']
+    fig, axes = plt.subplots(len(variables), len(variables), figsize=(2.5*len(variables), 2.5*len(variables)), squeeze=False)
+    for i in range(len(variables)): # row i shows variable i on the y axis
+        for j in range(len(variables)):
+            ax = axes[i, j]
+            if i == j:
+                ax.hist(edges[i][:-1], edges[i], weights=binned['counts'][i]) # one bar per bin with its count (works with matplotlib 3.2)
+            else:
+                counts = binned['counts2d'][j, i].T # rows are the bins of variable i
+                ax.imshow(np.ma.masked_equal(counts, 0), origin="lower", aspect="auto", cmap="viridis", interpolation="nearest",
+                          norm=LogNorm(vmin=1, vmax=max(counts.max(), 1)), extent=(edges[j][0], edges[j][-1], edges[i][0], edges[i][-1]))
+            if i == len(variables) - 1:
+                ax.set_xlabel(variables[j])
+            if j == 0:
+                ax.set_ylabel(variables[i])
+    fig.suptitle(f"{int(binned['num_guvs'])} GUVs")
+    plt.tight_layout()
+    plt.show()
+
+
+def _load_files(csvfiles, series, usecols=None):
+    alldata = []
+    for i,csvfile in enumerate(csvfiles):
+        data = pd.read_csv(csvfile, header=0, usecols=usecols)
+        data['series'] = series[i]
+        alldata.append(data)
+    return pd.concat(alldata, ignore_index=True)
+
+
+def run(binned=False, bins=100, max_per_series=None):
+    """Plot the data files selected by the user
+
+    Args:
+        binned (bool): plot binned data (`plot_binned`) instead of every GUV, for large numbers of GUVs; the bins are cached
+        bins (int): number of bins of every variable
+        max_per_series (int): only plot a random selection of at most this number of GUVs of every series (not binned)
+    """
     files = askopenfilenames(initialdir=".", title="Select files to plot...",
                                               filetypes=(("csv files", "*.csv"), ("All files", "*.*")))
 
     csvfiles,series = [],[]
     for f in sorted(files):
-        matches = re.match(r"(.*)s(\d*).csv$", f)
+        matches = re.match(r"(.*)_s(\d+)-GUVdata_\w+\.csv$", f) # see output.output_filename
         if not matches or len(matches.groups()) != 2:
             print(f"Excluding file {f} as it does not match the pattern, is it renamed?")
             continue
         csvfiles.append(f)
-        series.append(int(matches.group(2)))        
-    
-    alldata = pd.DataFrame()
-    for i,csvfile in enumerate(csvfiles):
-        data = pd.read_csv(csvfile, header=0)
-        data['series'] = series[i]
-        alldata = alldata.append(data,ignore_index=True)
-    
-    sns.pairplot(alldata,vars=["r_um", "intensity", "area"],hue="series")
-    plt.tight_layout()
-    plt.show()
+        series.append(int(matches.group(2)))
+
+    if not csvfiles:
+        return
+    if binned:
+        key = [(f, os.stat(f).st_size, os.stat(f).st_mtime_ns) for f in csvfiles]
+        plot_binned(cached_bins(key, lambda: _load_files(csvfiles, series, PLOT_VARIABLES), PLOT_VARIABLES, bins))
+        return
+    data = _load_files(csvfiles, series)
+    plot(subsample(data, max_per_series) if max_per_series else data)
+
+
+def run_query(index_filename=None, binned=False, bins=100, max_per_series=None, **filters):
+    """Plot the GUVs in the results index that match the filters of `ResultIndex.query`, coloured by file and series
 
+    See `run` for `binned`, `bins` and `max_per_series`
+    """
+    index = ResultIndex(index_filename)
+    if binned:
+        stat = os.stat(index.filename) # the bins are computed again when anything has been added to the index
+        binned_data = cached_bins([os.path.abspath(index.filename), stat.st_size, stat.st_mtime_ns, filters],
+                                  lambda: index.query(**filters), PLOT_VARIABLES, bins)
+        if binned_data['num_guvs'] == 0:
+            print("No GUVs match the query")
+            return
+        plot_binned(binned_data)
+        return
+    data = index.query(**filters)
+    if data.empty:
+        print("No GUVs match the query")
+        return
+    data['series'] = data['file'].map(os.path.basename) + data['series'].map(lambda s: '' if pd.isna(s) else ' s%02d' % s)
+    plot(subsample(data, max_per_series) if max_per_series else data)
@@ -0,0 +1,114 @@
+import numpy as np
+import pandas as pd
+
+
+class RegionStore:
+    """Compact, column-typed table of the regions that are detected in a stack
+
+    All columns are preallocated numpy arrays (int32 for frame numbers and ids, float32 for
+    the geometry) that grow geometrically when regions are appended, instead of a DataFrame
+    with object columns that is copied on every append. Columns are accessed like in a
+    DataFrame (`store['x']`), indexing with a boolean or integer array returns a new store
+    with the selected rows. Use `to_dataframe` where a DataFrame is needed.
+    """
+
+    COLUMNS = {
+        'frame': np.int32,
+        'x': np.float32,
+        'y': np.float32,
+        'r': np.float32,
+        'area': np.float32,
+        'ar': np.float32,
+    }
+    """Columns that every store has, with their types"""
+
+    EXTRA_COLUMN_TYPES = {
+        'guv_id': np.int32,
+        'num_points': np.int32,
+    }
+    """Types of columns that are added later on (e.g. by linking), other columns keep their own type"""
+
+    def __init__(self, capacity=1024):
+        self._size = 0
+        self._columns = {name: np.empty(capacity, dtype=dtype) for name, dtype in self.COLUMNS.items()}
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def empty(self):
+        return self._size == 0
+
+    @property
+    def columns(self):
+        return list(self._columns)
+
+    @property
+    def capacity(self):
+        return len(self._columns['frame'])
+
+    def _reserve(self, num_rows):
+        """Make sure that `num_rows` more rows fit, doubling the capacity if needed"""
+        if self._size + num_rows <= self.capacity:
+            return
+        capacity = max(2*self.capacity, self._size + num_rows)
+        for name, column in self._columns.items():
+            grown = np.empty(capacity, dtype=column.dtype)
+            grown[:self._size] = column[:self._size]
+            self._columns[name] = grown
+
+    def append(self, **columns):
+        """Append rows, every column of the store should be given (scalars are repeated for all rows)
+
+        Example:
+            store.append(frame=3, x=xs, y=ys, r=rs, area=areas, ar=ars)
+        """
+        lengths = [len(values) for values in columns.values() if np.ndim(values) > 0]
+        num_rows = max(lengths) if lengths else 1
+        if set(columns) != set(self._columns):
+            raise ValueError(f"Expected the columns {self.columns}, got {list(columns)}")
+        self._reserve(num_rows)
+        for name, values in columns.items():
+            self._columns[name][self._size:self._size+num_rows] = values
+        self._size += num_rows
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self._columns[key][:self._size]
+        # select rows with a boolean mask or integer indices
+        selection = RegionStore(capacity=0)
+        selection._columns = {name: column[:self._size][key] for name, column in self._columns.items()}
+        selection._size = len(selection._columns['frame'])
+        return selection
+
+    def __setitem__(self, name, values):
+        dtype = self.COLUMNS.get(name, self.EXTRA_COLUMN_TYPES.get(name))
+        values = np.asarray(values, dtype=dtype)
+        if values.ndim == 0:
+            values = np.full(self._size, values)
+        if len(values) != self._size:
+            raise ValueError(f"Column {name} should have {self._size} values, not {len(values)}")
+        column = np.empty(self.capacity, dtype=values.dtype)
+        column[:self._size] = values
+        self._columns[name] = column
+
+    def __getstate__(self):
+        # only the used part of the columns is pickled
+        return {'_size': self._size, '_columns': {name: column[:self._size] for name, column in self._columns.items()}}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def to_dataframe(self):
+        """Convert to a DataFrame (the data is copied)"""
+        return pd.DataFrame({name: column[:self._size].copy() for name, column in self._columns.items()})
+
+    @staticmethod
+    def from_dataframe(dataframe: pd.DataFrame):
+        """Create a store from a DataFrame that has (at least) all columns in `COLUMNS`"""
+        store = RegionStore(capacity=len(dataframe))
+        store.append(**{name: dataframe[name].to_numpy() for name in RegionStore.COLUMNS})
+        for name in dataframe.columns:
+            if name not in RegionStore.COLUMNS:
+                store[name] = dataframe[name].to_numpy()
+        return store
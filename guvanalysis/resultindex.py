@@ -0,0 +1,166 @@
+import os
+import json
+import sqlite3
+from dataclasses import asdict
+from datetime import datetime
+import pandas as pd
+from .parameters import ParameterList
+
+GUV_COLUMNS = {
+    'frame': 'INTEGER',
+    'x': 'REAL',
+    'y': 'REAL',
+    'r': 'REAL',
+    'r_um': 'REAL',
+    'area': 'REAL',
+    'ar': 'REAL',
+    'intensity': 'REAL',
+    'num_points': 'INTEGER',
+    'z_min': 'INTEGER',
+    'z_max': 'INTEGER',
+}
+"""Columns of the GUV data that are stored in the index (columns missing in older data files are left empty)"""
+
+
+class ResultIndex:
+    """Database (SQLite) with the results of all analyses, such that they can be queried without reading all data files
+
+    Every stored data file is an analysis (with the analysed file, series, time point, date and
+    parameters), the GUVs of all analyses are stored in a single table with indexes on the
+    columns that are commonly filtered on. Every operation opens its own connection, so the
+    index can be used from several threads and processes at the same time.
+    """
+
+    DEFAULT_FILENAME = os.path.join(os.path.expanduser("~"), ".guvanalysis", "results.sqlite")
+
+    def __init__(self, filename=None):
+        self.filename = filename or self.DEFAULT_FILENAME
+        os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+        with self._connect() as connection:
+            connection.executescript(f"""
+                CREATE TABLE IF NOT EXISTS analyses (
+                    id INTEGER PRIMARY KEY,
+                    file TEXT NOT NULL,
+                    series INTEGER,
+                    time_point INTEGER,
+                    created TEXT NOT NULL,
+                    data_file TEXT UNIQUE NOT NULL,
+                    parameters TEXT NOT NULL,
+                    num_guvs INTEGER NOT NULL,
+                    key TEXT
+                );
+                CREATE TABLE IF NOT EXISTS guvs (
+                    analysis_id INTEGER NOT NULL REFERENCES analyses(id) ON DELETE CASCADE,
+                    {', '.join(f'{name} {sqltype}' for name, sqltype in GUV_COLUMNS.items())}
+                );
+            """)
+            if 'key' not in [column[1] for column in connection.execute("PRAGMA table_info(analyses)")]:
+                connection.execute("ALTER TABLE analyses ADD COLUMN key TEXT") # index created before analyses had keys
+            connection.executescript("""
+                CREATE INDEX IF NOT EXISTS analyses_file ON analyses(file);
+                CREATE INDEX IF NOT EXISTS analyses_created ON analyses(created);
+                CREATE INDEX IF NOT EXISTS analyses_key ON analyses(key);
+                CREATE INDEX IF NOT EXISTS guvs_analysis ON guvs(analysis_id);
+                CREATE INDEX IF NOT EXISTS guvs_r_um ON guvs(r_um);
+                CREATE INDEX IF NOT EXISTS guvs_intensity ON guvs(intensity);
+            """)
+        connection.close()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.filename, timeout=30)
+        connection.execute("PRAGMA foreign_keys = ON")
+        return connection
+
+    def add(self, params: ParameterList, guv_data: pd.DataFrame, data_file, created=None, key=None):
+        """Add the results of an analysis (replaces earlier results that were stored in the same data file)
+
+        Args:
+            params (ParameterList): parameters of the analysis
+            guv_data (pd.DataFrame): data of the GUVs
+            data_file (str): file in which the data has been stored
+            created (datetime): date of the analysis (now if None)
+            key (str): key of the analysis (see `manifest.analysis_key`), used by `find`
+        """
+        created = (created or datetime.now()).isoformat(timespec='seconds')
+        columns = []
+        for name, sqltype in GUV_COLUMNS.items():
+            values = guv_data[name].to_numpy(dtype=float).tolist() if name in guv_data else [None]*len(guv_data)
+            columns.append([None if v is None or v != v else (int(v) if sqltype == 'INTEGER' else v) for v in values]) # NaN is stored as NULL
+        with self._connect() as connection:
+            connection.execute("DELETE FROM analyses WHERE data_file = ?", (os.path.abspath(data_file),))
+            cursor = connection.execute(
+                "INSERT INTO analyses (file, series, time_point, created, data_file, parameters, num_guvs, key) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (os.path.abspath(params.filename), params.series, params.time_point, created,
+                 os.path.abspath(data_file), json.dumps(asdict(params)), len(guv_data), key))
+            connection.executemany(
+                f"INSERT INTO guvs (analysis_id, {', '.join(GUV_COLUMNS)}) VALUES (?{', ?'*len(GUV_COLUMNS)})",
+                ((cursor.lastrowid, *row) for row in zip(*columns)))
+        connection.close()
+
+    def add_data_file(self, data_file):
+        """Add a data file of an earlier analysis, with the parameters from the GUVparams file next to it
+
+        Returns:
+            int: the number of GUVs in the file
+        """
+        params = ParameterList.from_json(data_file.replace("GUVdata", "GUVparams").replace(".csv", ".json"))
+        guv_data = pd.read_csv(data_file, header=0)
+        self.add(params, guv_data, data_file, datetime.fromtimestamp(os.path.getmtime(data_file)))
+        return len(guv_data)
+
+    def find(self, key):
+        """Return the data file of the most recent analysis with this key that still exists, or None"""
+        with self._connect() as connection:
+            data_files = [row[0] for row in connection.execute("SELECT data_file FROM analyses WHERE key = ? ORDER BY id DESC", (key,))]
+        connection.close()
+        return next((data_file for data_file in data_files if os.path.exists(data_file)), None)
+
+    @staticmethod
+    def _conditions(file=None, since=None, until=None, where=None):
+        conditions, arguments = [], []
+        if file is not None:
+            conditions.append("a.file GLOB ?")
+            arguments.append(file)
+        if since is not None:
+            conditions.append("a.created >= ?")
+            arguments.append(since)
+        if until is not None:
+            conditions.append("a.created < ?")
+            arguments.append(until)
+        if where is not None:
+            conditions.append(f"({where})")
+        return (" WHERE " + " AND ".join(conditions) if conditions else ""), arguments
+
+    def query(self, file=None, since=None, until=None, where=None):
+        """Get the GUVs of all analyses that match the filters
+
+        Args:
+            file (str): pattern of the analysed files, e.g. `*/plate_*.nd2`
+            since, until (str): only analyses in this period (ISO dates, e.g. `2020-05-01`; until is excluded)
+            where (str): SQL condition on the GUV columns, e.g. `r_um > 10 AND intensity > 0.5`
+
+        Returns:
+            pd.DataFrame: the GUVs, with the file, series, time point, date and data file of their analysis
+        """
+        conditions, arguments = self._conditions(file, since, until, where)
+        with self._connect() as connection:
+            data = pd.read_sql_query(
+                f"SELECT a.file, a.series, a.time_point, a.created, a.data_file, {', '.join(f'g.{name}' for name in GUV_COLUMNS)} "
+                f"FROM guvs AS g JOIN analyses AS a ON g.analysis_id = a.id{conditions} ORDER BY a.id", connection, params=arguments)
+        connection.close()
+        return data
+
+    def analyses(self, file=None, since=None, until=None, where=None):
+        """Get the analyses that match the filters (see `query`), with their parameters (json)
+
+        With `where`, only the analyses with at least one GUV that matches the condition are returned
+        """
+        conditions, arguments = self._conditions(file, since, until)
+        if where is not None:
+            conditions += (" AND " if conditions else " WHERE ") + f"EXISTS (SELECT 1 FROM guvs AS g WHERE g.analysis_id = a.id AND ({where}))"
+        with self._connect() as connection:
+            data = pd.read_sql_query(
+                f"SELECT a.file, a.series, a.time_point, a.created, a.data_file, a.num_guvs, a.parameters "
+                f"FROM analyses AS a{conditions} ORDER BY a.id", connection, params=arguments)
+        connection.close()
+        return data
@@ -0,0 +1,77 @@
+from collections import namedtuple
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+except ImportError: # python < 3.8, the frames are then processed in the main process
+    shared_memory = None
+
+
+def available():
+    """Whether frames can be shared between processes (python >= 3.8)"""
+    return shared_memory is not None
+
+FrameDescriptor = namedtuple('FrameDescriptor', ['name', 'shape', 'dtype', 'offset'])
+"""Location of a single frame in a block of shared memory, this is all that is sent to a worker process"""
+
+
+class SharedFrameBuffer:
+    """Block of shared memory that holds a number of frames of the same shape and type
+
+    The process that creates the buffer fills it (e.g. with the 8-bit frames of a stack) and
+    passes `descriptor(i)` to worker processes, which get the frame with `attach` without
+    copying or pickling any pixel data. Workers can also write into the buffer, e.g. to return
+    the filled masks. The shared memory is released by `close` (or at the end of a `with` block).
+
+    Example:
+        with SharedFrameBuffer(len(stack), stack.frame_shape) as frames:
+            for i, frame in enumerate(stack):
+                frames.array[i] = frame
+            executor.map(process, [frames.descriptor(i) for i in range(len(stack))])
+    """
+
+    def __init__(self, num_frames, shape, dtype=np.uint8):
+        self.shape = tuple(int(s) for s in shape)
+        self.dtype = np.dtype(dtype)
+        self.frame_nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self._shm = shared_memory.SharedMemory(create=True, size=max(num_frames * self.frame_nbytes, 1))
+        self.array = np.ndarray((num_frames,) + self.shape, dtype=self.dtype, buffer=self._shm.buf)
+        """All frames, as an array that can be written to"""
+
+    def __len__(self):
+        return len(self.array)
+
+    def descriptor(self, i):
+        return FrameDescriptor(self._shm.name, self.shape, self.dtype.str, i * self.frame_nbytes)
+
+    def close(self):
+        if self._shm is None:
+            return
+        del self.array # the memory can only be released when no array uses it anymore
+        self._shm.close()
+        self._shm.unlink()
+        self._shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_attached = {}
+"""Shared memory blocks that have been opened by this (worker) process, by name"""
+
+
+def attach(descriptor: FrameDescriptor):
+    """Get the frame of a descriptor as an array that uses the shared memory directly (zero-copy)
+
+    Blocks are opened once per process and stay open as long as the process lives (worker
+    processes only live as long as their pool). Workers share the resource tracker of the
+    process that created the block, so the block is only removed by `SharedFrameBuffer.close`.
+    """
+    shm = _attached.get(descriptor.name)
+    if shm is None:
+        shm = shared_memory.SharedMemory(name=descriptor.name)
+        _attached[descriptor.name] = shm
+    return np.ndarray(descriptor.shape, dtype=np.dtype(descriptor.dtype), buffer=shm.buf, offset=descriptor.offset)
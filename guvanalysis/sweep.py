@@ -0,0 +1,104 @@
+import os
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import replace, fields
+import numpy as np
+import pandas as pd
+from .parameters import ParameterList
+from .guvfinder import GUV_finder, helpers
+from .regionstore import RegionStore
+
+
+def parse_range(text, vartype=float):
+    """Parse the values of a parameter for the sweep
+
+    Accepts a single value (`5`), a comma separated list (`1,2,5`) or a range `start:stop:step` (stop included)
+
+    Returns:
+        list: values of the parameter
+    """
+    if ":" in text:
+        start, stop, step = map(float, text.split(":"))
+        values = np.arange(start, stop + step/2, step)
+    else:
+        values = [float(v) for v in text.split(",")]
+    return [vartype(v) for v in values]
+
+
+def parameter_types():
+    """Type (int or float) of every adjustable parameter"""
+    types = {field.name: field.type for field in fields(ParameterList)}
+    return {varname: int if types[varname] in (int, 'int') else float for varname in ParameterList().get_adjustable_variables()}
+
+
+def detect_regions(params: ParameterList):
+    """Run the edge detection once for the `blur_radius` in `params`, returns the unfiltered regions"""
+    finder = GUV_finder(helpers.open_stack(params, t=params.time_point), params)
+    return params.blur_radius, finder.detect_regions()
+
+
+def evaluate_combinations(params: ParameterList, regions: RegionStore, combinations):
+    """Filter and link the regions of a single `blur_radius` for a list of parameter combinations
+
+    Args:
+        params (ParameterList): base parameters
+        regions (RegionStore): unfiltered regions as returned by `GUV_finder.detect_regions`
+        combinations (list of dict): parameters that are changed for each evaluation
+
+    Returns:
+        list of dict: summary (number of GUVs, radius distribution) for every combination
+    """
+    finder = GUV_finder(helpers.open_stack(params, t=params.time_point), params)
+    finder.snapshot_filename = None
+    summaries = []
+    for combination in combinations:
+        finder.params = replace(params, **combination)
+        finder.frames_regions = helpers.filter_GUV_dataframe(regions, finder.params)
+        finder.link_GUV_points()
+        finder.get_GUVs_from_linked_points()
+        r, r_um = finder.guv_data['r'].to_numpy(dtype=float), finder.guv_data['r_um'].to_numpy(dtype=float)
+        summary = dict(combination)
+        summary['num_guvs'] = len(r)
+        summary['r_mean'] = r.mean() if len(r) else np.nan
+        summary['r_std'] = r.std() if len(r) else np.nan
+        summary['r_p10'], summary['r_median'], summary['r_p90'] = np.percentile(r, [10, 50, 90]) if len(r) else (np.nan,)*3
+        summary['r_um_mean'] = r_um.mean() if len(r_um) else np.nan
+        summaries.append(summary)
+    return summaries
+
+
+def run_sweep(params: ParameterList, ranges: dict, max_workers: int = None, chunksize: int = 8):
+    """Evaluate the analysis for all combinations of the given parameter values
+
+    The edge detection is performed once for every unique `blur_radius`, after which filtering
+    and linking (which are cheap) are performed for all other combinations. Both steps are
+    spread over a process pool.
+
+    Args:
+        params (ParameterList): base parameters (file, channel, series and the values of parameters that are not swept)
+        ranges (dict): values for every swept parameter, e.g. {'blur_radius': [1., 2.], 'track_min_length': [2, 3, 4]}
+        max_workers (int): number of worker processes (number of cpus if None)
+        chunksize (int): number of combinations that is evaluated by a worker at once
+
+    Returns:
+        pd.DataFrame: summary table with one row per combination
+    """
+    blur_radii = ranges.get('blur_radius', [params.blur_radius])
+    other_names = [name for name in ranges if name != 'blur_radius']
+    other_combinations = [dict(zip(other_names, values)) for values in itertools.product(*[ranges[name] for name in other_names])]
+
+    summaries = []
+    with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        detections = executor.map(detect_regions, [replace(params, blur_radius=blur_radius) for blur_radius in blur_radii])
+        evaluations = []
+        for blur_radius, regions in detections:
+            print(f"Detected {len(regions)} regions for blur_radius={blur_radius}")
+            for i in range(0, len(other_combinations), chunksize):
+                chunk = [dict(combination, blur_radius=blur_radius) for combination in other_combinations[i:i+chunksize]]
+                evaluations.append(executor.submit(evaluate_combinations, params, regions, chunk))
+        for evaluation in evaluations:
+            summaries.extend(evaluation.result())
+
+    columns = ['blur_radius'] + other_names
+    summary = pd.DataFrame(summaries).sort_values(columns).reset_index(drop=True)
+    return summary[columns + [c for c in summary.columns if c not in columns]]
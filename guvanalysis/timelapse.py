@@ -0,0 +1,156 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import replace
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+from .parameters import ParameterList
+from .guvfinder import GUV_finder
+from .framesource import open_frame_source, ND2MemmapSource, TiffSequenceSource
+from .output import output_filename
+
+TIMELAPSE_COLUMNS = ['guv_id', 't', 'x', 'y', 'frame', 'r', 'r_um', 'area', 'intensity']
+
+_source = None # frame source of a worker process, used for all its time points (see `_init_worker`)
+
+
+def _init_worker(source):
+    # sources that can be pickled are sent once to every worker, other files are opened once by every worker
+    global _source
+    _source = open_frame_source(source) if isinstance(source, str) else source
+
+
+def analyse_time_point(params: ParameterList, t: int, source=None):
+    """Find the GUVs in the z-stack of a single time point
+
+    Runs in a worker process of `analyse_timelapse`, which keeps the frame source of the file open for all time points
+
+    Args:
+        params (ParameterList): parameters used for the analysis
+        t (int): index of the time point
+        source (FrameSource): the opened file of `params` (the source of the worker process if None)
+
+    Returns:
+        (int, pd.DataFrame): the time point and the GUVs found in its z-stack
+    """
+    if source is None:
+        source = _source
+    params = replace(params, time_point=t)
+    if source is None:
+        with open_frame_source(params.filename) as source:
+            return analyse_time_point(params, t, source)
+    finder = GUV_finder(source.zstack(c=params.channel, v=params.series, t=t), params)
+    finder.snapshot_filename = None
+    finder.run_analysis()
+    data = finder.get_data().drop(columns=['guv_id'])
+    data['t'] = t
+    return t, data
+
+
+class GUV_time_linker:
+    """Links the GUVs of consecutive time points together
+
+    Every GUV of a new time point is matched with the closest GUV that was seen in the last
+    `track_t_memory` time points (within `track_t_thresh` px), closest pairs are matched first
+    """
+
+    def __init__(self, params: ParameterList):
+        self.xy_thresh = params.track_t_thresh
+        self.memory = params.track_t_memory
+        self.active = pd.DataFrame(columns=['guv_id', 'x', 'y', 't']) # last known position of every GUV that is still tracked
+        self.next_id = 0
+
+    def link(self, data: pd.DataFrame, t=None):
+        """Assign a `guv_id` to all GUVs of a single time point
+
+        A GUV can be missing in at most `track_t_memory` consecutive time points to keep its id
+
+        Args:
+            data (pd.DataFrame): GUVs of one time point, time points should be passed in increasing order
+            t (int): the time point (taken from the `t` column of `data` if None, which needs at least one GUV)
+
+        Returns:
+            pd.DataFrame: the same data with the `guv_id` column added
+        """
+        data = data.reset_index(drop=True)
+        ids = np.full(len(data), -1, dtype=int)
+        if len(data) > 0 and len(self.active) > 0:
+            cur_xy = data[['x', 'y']].to_numpy(dtype=float)
+            prev_xy = self.active[['x', 'y']].to_numpy(dtype=float)
+            pairs = cKDTree(cur_xy).sparse_distance_matrix(cKDTree(prev_xy), self.xy_thresh, output_type='ndarray')
+            used_prev = set()
+            for pair in pairs[np.argsort(pairs['v'], kind='stable')]: # closest pairs first
+                if ids[pair['i']] == -1 and pair['j'] not in used_prev:
+                    ids[pair['i']] = self.active['guv_id'].iat[pair['j']]
+                    used_prev.add(pair['j'])
+        new = ids == -1
+        ids[new] = np.arange(self.next_id, self.next_id + new.sum())
+        self.next_id += int(new.sum())
+        data['guv_id'] = ids
+
+        # update the last known positions and forget GUVs that have been missing for too long (also at time points without GUVs)
+        if t is None:
+            t = data['t'].iat[0]
+        seen = data[['guv_id', 'x', 'y', 't']]
+        if len(self.active) == 0:
+            self.active = seen.reset_index(drop=True)
+        elif len(seen) > 0:
+            self.active = pd.concat([self.active[~self.active['guv_id'].isin(ids)], seen], ignore_index=True)
+        self.active = self.active[t - self.active['t'] <= self.memory].reset_index(drop=True)
+        return data
+
+
+def analyse_timelapse(params: ParameterList, outfilename: str = None, time_points=None, max_workers: int = None):
+    """Analyse all time points of a file and link the GUVs over time
+
+    Time points are analysed concurrently in a process pool. Finished time points are
+    linked in order and directly appended to the output file, such that only the
+    time points that are being processed are kept in memory.
+
+    Args:
+        params (ParameterList): parameters used for the analysis of every time point
+        outfilename (str): csv file to write the long-format table (guv_id, t, x, y, frame, r, r_um, area, intensity) to
+        time_points (iterable): time points to analyse (all time points in the file if None)
+        max_workers (int): number of worker processes (number of cpus if None)
+
+    Returns:
+        str: the filename of the written table
+    """
+    if outfilename is None:
+        outfilename = output_filename(params, "GUVtimelapse", ".csv")
+    max_workers = max_workers or os.cpu_count()
+    linker = GUV_time_linker(params)
+    # the file is opened once for all time points, memory-mapped sources are cheap to send to the workers
+    source = open_frame_source(params.filename)
+    worker_source = source if isinstance(source, (ND2MemmapSource, TiffSequenceSource)) else params.filename
+
+    with source, ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(worker_source,)) as executor, \
+            open(outfilename, "w", newline="") as outfile:
+        if time_points is None:
+            time_points = range(source.sizes.get('t', 1))
+        time_points = sorted(time_points)
+        pd.DataFrame(columns=TIMELAPSE_COLUMNS).to_csv(outfile, index=False, header=True)
+        max_in_flight = 2*max_workers # limit the number of time points that are kept in memory
+        to_submit = iter(time_points)
+        next_index = 0 # index in time_points of the next time point to link
+        running, finished = set(), {}
+        while next_index < len(time_points):
+            while len(running) + len(finished) < max_in_flight:
+                t = next(to_submit, None)
+                if t is None:
+                    break
+                running.add(executor.submit(analyse_time_point, params, t))
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                t, data = future.result()
+                finished[t] = data
+            # time points have to be linked in order, so only write the ones that are next in line
+            while next_index < len(time_points) and time_points[next_index] in finished:
+                data = linker.link(finished.pop(time_points[next_index]), time_points[next_index])
+                data.reindex(columns=TIMELAPSE_COLUMNS).to_csv(outfile, index=False, header=False)
+                outfile.flush()
+                print(f"Time point {time_points[next_index]}: {len(data)} GUVs")
+                next_index += 1
+
+    params.to_json(outfilename.replace(".csv", ".json"))
+    return outfilename
@@ -0,0 +1,189 @@
+import os
+import glob
+import json
+import time
+import queue
+import signal
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import replace
+from .parameters import ParameterList
+from .framesource import open_frame_source, TiffSequenceSource
+from .manifest import RunManifest, analysis_key, content_hash
+from .output import ResultWriter, store_results, find_results
+from .batch import find_series_GUVs
+
+
+class FolderWatcher:
+    """Analyses new files in a directory (and its subdirectories) while they are being acquired
+
+    The directory is scanned for nd2 files and directories with tif files every `poll_interval`
+    seconds. An input is ready when it has not changed for `settle_time` seconds and can be
+    opened (nd2 files can only be read once the microscope has finished writing them, tif
+    directories are complete when every channel has all z slices). The series of a ready input
+    are added to the queue, the series of which all frames can be read are analysed by a pool of
+    `max_workers` processes with the parameters in `params` (the filename and series are replaced).
+
+    The queue and the state of the inputs are stored in `_GUVwatch.json` in the directory, such
+    that the watcher continues with the remaining series when it is started again. Series that
+    have been analysed before with the same parameters are skipped (see `output.find_results`).
+    """
+
+    STATE_FILENAME = "_GUVwatch.json"
+
+    def __init__(self, directory, params: ParameterList, max_workers: int = None, poll_interval=10., settle_time=30.):
+        self.directory = os.path.abspath(directory)
+        self.params = params
+        self.max_workers = max_workers or os.cpu_count()
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        self.state_filename = os.path.join(self.directory, self.STATE_FILENAME)
+        self.inputs = {} # signature of every input and whether its series have been queued
+        self.jobs = [] # queued, running, writing, finished and failed series
+        self._load_state()
+
+    def _load_state(self):
+        if not os.path.exists(self.state_filename):
+            return
+        with open(self.state_filename, "r") as statefile:
+            state = json.load(statefile)
+        self.inputs = state['inputs']
+        self.jobs = state['jobs']
+        for job in self.jobs:
+            if job['status'] in ('running', 'writing'): # interrupted, so start again
+                job['status'] = 'queued'
+
+    def _save_state(self):
+        with open(self.state_filename + ".tmp", "w") as statefile:
+            json.dump({'inputs': self.inputs, 'jobs': self.jobs}, statefile, indent=4)
+        os.replace(self.state_filename + ".tmp", self.state_filename)
+
+    def find_inputs(self):
+        """Return the inputs in the directory with their signature (size and time of the last change)"""
+        inputs = {}
+        for filename in glob.glob(os.path.join(self.directory, "**", "*.nd2"), recursive=True):
+            stat = os.stat(filename)
+            inputs[filename] = [stat.st_size, stat.st_mtime_ns]
+        for dirpath, _, filenames in os.walk(self.directory):
+            stats = [os.stat(os.path.join(dirpath, f)) for f in filenames if f.endswith(".tif")]
+            if stats:
+                inputs[os.path.join(dirpath, "*.tif")] = [sum(s.st_size for s in stats), max(s.st_mtime_ns for s in stats)]
+        return inputs
+
+    def scan(self):
+        """Update the state of all inputs and queue the series of inputs that are ready
+
+        Returns:
+            int: number of series that were added to the queue
+        """
+        now = time.time()
+        num_queued = 0
+        for filename, signature in self.find_inputs().items():
+            entry = self.inputs.setdefault(filename, {'signature': signature, 'queued': False})
+            if entry['signature'] != signature: # changed after it was queued, it is queued again when it is ready
+                entry.update(signature=signature, queued=False)
+            if entry['queued'] or now - signature[1]/1e9 < self.settle_time: # still being written
+                continue
+            series = self.complete_series(filename)
+            if series is None:
+                continue
+            contents = content_hash(filename)
+            for i in series:
+                params = replace(self.params, filename=filename, series=i)
+                resultsfilename = find_results(params, analysis_key(params, contents))
+                self.jobs.append({'filename': filename, 'series': i, 'status': 'finished' if resultsfilename else 'queued',
+                                  'results': resultsfilename, 'queued_at': now})
+                num_queued += resultsfilename is None
+            entry['queued'] = True
+        self._save_state()
+        return num_queued
+
+    def complete_series(self, filename):
+        """Return the series of an input of which all frames can be read, or None if the input cannot be read (yet)"""
+        try:
+            with open_frame_source(filename) as source:
+                if isinstance(source, TiffSequenceSource) and not source.complete:
+                    return None # not all z slices of every channel are there
+                num_z = source.sizes.get('z', 1)
+                series = list(range(source.sizes['v'])) if 'v' in source.sizes else [None]
+                for i in series:
+                    source.get_frame(v=i or 0, t=self.params.time_point, z=num_z-1, c=self.params.channel)
+                return series
+        except Exception as e:
+            print(f"{filename} cannot be read yet ({e})")
+            return None
+
+    def _mark_written(self, written: queue.Queue, flushed=False):
+        """Mark the series of which both files have been written as finished
+
+        Args:
+            written (queue.Queue): the jobs that have been written (filled by the writer thread)
+            flushed (bool): whether the writer has been flushed, series that are still being written have then failed
+        """
+        while not written.empty():
+            job = written.get()
+            job.update(status='finished', finished_at=time.time())
+            print(f"Data for {job['num_guvs']} GUVs of series {job['series']} of {job['filename']} stored in {job['results']}")
+        if flushed:
+            for job in self.jobs:
+                if job['status'] == 'writing':
+                    job.update(status='failed', results=None, error="The results could not be written", finished_at=time.time())
+
+    def run(self, once=False):
+        """Watch the directory until interrupted (Ctrl+C), or until everything that is ready has been analysed if `once`"""
+        writer = ResultWriter()
+        written = queue.Queue() # the series are only finished once their files have been written
+        running = {}
+        print(f"Watching {self.directory} for new files")
+        try:
+            with ProcessPoolExecutor(max_workers=self.max_workers, initializer=_ignore_interrupt) as executor:
+                self.scan()
+                while True:
+                    for job in self.jobs:
+                        if len(running) >= self.max_workers:
+                            break
+                        if job['status'] == 'queued':
+                            job['status'] = 'running'
+                            job['started_at'] = time.time()
+                            params = replace(self.params, filename=job['filename'], series=job['series'])
+                            manifest = RunManifest(job['filename'], content_hash(job['filename'])) # only hashed again when the file has changed
+                            running[executor.submit(find_series_GUVs, params, manifest)] = job
+                            print(f"Analysing series {job['series']} of {job['filename']}")
+                    self._mark_written(written)
+                    self._save_state()
+                    if not running: # nothing to wait for, but the last results may still be written
+                        try:
+                            writer.flush()
+                        except Exception:
+                            pass # the errors have been printed, the series are marked as failed
+                        self._mark_written(written, flushed=True)
+                        if once:
+                            break
+                        time.sleep(self.poll_interval)
+                    done, _ = wait(list(running), timeout=self.poll_interval, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        job = running.pop(future)
+                        try:
+                            params, guv_data = future.result()
+                            job.update(status='writing', num_guvs=len(guv_data))
+                            job['results'], _ = store_results(params, guv_data, RunManifest(params.filename), writer,
+                                                              callback=lambda job=job: written.put(job))
+                        except Exception as e:
+                            job.update(status='failed', error=str(e), finished_at=time.time())
+                            print(f"Analysis of series {job['series']} of {job['filename']} failed: {e}")
+                    if not once:
+                        self.scan()
+        except KeyboardInterrupt:
+            print("Stopping, unfinished series are analysed again when the watcher is restarted")
+        finally:
+            for job in running.values():
+                job['status'] = 'queued'
+            try:
+                writer.close()
+            finally:
+                self._mark_written(written, flushed=True)
+                self._save_state()
+
+
+def _ignore_interrupt():
+    # Ctrl+C is handled by the watcher, which lets the workers finish their series
+    signal.signal(signal.SIGINT, signal.SIG_IGN)